@@ -3,9 +3,12 @@
 
 import os
 import sys
+import json
+import hmac
+import httpx
 import traceback
 from http import HTTPStatus
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.cosmos.cosmos_client import CosmosClient
 from aiohttp import web
 from aiohttp.web import Request, Response, json_response
@@ -15,20 +18,20 @@ from botbuilder.azure import (
 )
 from botbuilder.core import (
     ConversationState,
-    MemoryStorage,
     TurnContext,
     UserState,
 )
 from botbuilder.core.integration import aiohttp_error_middleware
 from botbuilder.integration.aiohttp import CloudAdapter, ConfigurationBotFrameworkAuthentication
-from botbuilder.schema import Activity
+from botbuilder.schema import Activity, ActivityTypes, DeliveryModes
 
-from openai import AzureOpenAI
-from services import Phi
+from openai import AsyncAzureOpenAI
+from services import Backend, LoadBalancingTransport, Phi, TurnQueue
 from dotenv import load_dotenv
 
-from bots import AssistantBot, ChatCompletionBot, PhiBot, SemanticKernelBot
+from bots import AssistantBot, ChatCompletionBot, PhiBot, RouterBot, SemanticKernelBot
 from dialogs import LoginDialog
+from storage import BoundedMemoryStorage, SqliteStorage
 from config import DefaultConfig
 
 load_dotenv()
@@ -57,22 +60,39 @@ async def on_error(context: TurnContext, error: Exception):
 # Set the error handler on the Adapter.
 adapter.on_turn_error = on_error
 
-# Set up service authentication
+# Set up service authentication. The async credential fetches tokens without blocking the event loop.
 credential = DefaultAzureCredential(managed_identity_client_id=os.getenv("MicrosoftAppId"))
 
+# Optionally spread chat completions over additional endpoints/deployments,
+# e.g. AZURE_OPENAI_BACKENDS='[{"endpoint": "https://...", "deployment": "gpt-4o", "api_key": ""}]'
+aoai_transport = None
+if os.getenv("AZURE_OPENAI_BACKENDS"):
+    aoai_transport = LoadBalancingTransport(
+        [Backend(os.getenv("AZURE_OPENAI_API_ENDPOINT"), os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"))] + [
+            Backend(backend["endpoint"], backend["deployment"], backend.get("api_key"))
+            for backend in json.loads(os.getenv("AZURE_OPENAI_BACKENDS"))
+        ],
+        max_wait=float(os.getenv("AZURE_OPENAI_MAX_RETRY_WAIT", 60)),
+        deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+    )
+
 # Azure AI Services
-aoai_client = AzureOpenAI(
+aoai_client = AsyncAzureOpenAI(
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     azure_endpoint=os.getenv("AZURE_OPENAI_API_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_API_KEY"),
     azure_ad_token_provider=get_bearer_token_provider(
         credential, 
         "https://cognitiveservices.azure.com/.default"
-    )
+    ),
+    # The transport retries on other backends, so the client must not retry on its own
+    http_client=httpx.AsyncClient(transport=aoai_transport) if aoai_transport else None,
+    max_retries=0 if aoai_transport else 2
 )
 
 # Conversation history storage
 storage = None
+sqlite_storage = None
 if os.getenv("AZURE_COSMOSDB_ENDPOINT"):
     storage = CosmosDbPartitionedStorage(
         CosmosDbPartitionedConfig(
@@ -83,8 +103,16 @@ if os.getenv("AZURE_COSMOSDB_ENDPOINT"):
         )
     )
     # storage.client = CosmosClient(os.getenv("AZURE_COSMOSDB_ENDPOINT"), auth=credential)
+elif os.getenv("SQLITE_STORAGE_PATH"):
+    # Shared by all workers on the node
+    sqlite_storage = SqliteStorage(os.getenv("SQLITE_STORAGE_PATH"))
+    storage = sqlite_storage
 else:
-    storage = MemoryStorage()
+    storage = BoundedMemoryStorage(
+        max_entries=int(os.getenv("MEMORY_STORAGE_MAX_ENTRIES", 10000)),
+        max_bytes=int(os.getenv("MEMORY_STORAGE_MAX_BYTES", 256 * 1024 * 1024)),
+        ttl_seconds=float(os.getenv("MEMORY_STORAGE_TTL_SECONDS", 86400))
+    )
 
 # Create conversation and user state
 user_state = UserState(storage)
@@ -93,7 +121,16 @@ conversation_state = ConversationState(storage)
 # Create the bot
 dialog = LoginDialog()
 bot = None
+phi_client = None
 engine = os.getenv("GEN_AI_IMPLEMENTATION")
+if engine in ("phi", "router"):
+    phi_client = Phi(
+        deployment_endpoint=os.getenv("AZURE_AI_PHI_DEPLOYMENT_ENDPOINT"),
+        deployment_key=os.getenv("AZURE_AI_PHI_DEPLOYMENT_KEY"),
+        timeout=float(os.getenv("AZURE_AI_PHI_TIMEOUT", 120)),
+        max_connections=int(os.getenv("AZURE_AI_PHI_MAX_CONNECTIONS", 100))
+    )
+
 if engine == "chat-completions":
     bot = ChatCompletionBot(conversation_state, user_state, aoai_client, dialog)
 elif engine == "assistant":
@@ -103,11 +140,21 @@ elif engine == "semantic-kernel":
 elif engine == "langchain":
     raise ValueError("Langchain is not supported in this version.")
 elif engine == "phi":
-    phi_client = Phi(deployment_endpoint=os.getenv("AZURE_AI_PHI_DEPLOYMENT_ENDPOINT"), deployment_key=os.getenv("AZURE_AI_PHI_DEPLOYMENT_KEY"))
-    bot = PhiBot(conversation_state, user_state, phi_client)
+    bot = PhiBot(conversation_state, user_state, phi_client, dialog)
+elif engine == "router":
+    bot = RouterBot(conversation_state, user_state, aoai_client, phi_client, dialog)
 else:
     raise ValueError("Invalid engine type")
 
+# Optionally acknowledge messages at once and process them on background workers
+turn_queue = None
+if os.getenv("ASYNC_TURNS", "false") != "false":
+    turn_queue = TurnQueue(
+        lambda authenticate_result, activity: adapter.process_activity(authenticate_result, activity, bot.on_turn),
+        max_size=int(os.getenv("ASYNC_TURNS_QUEUE_SIZE", 1000)),
+        workers=int(os.getenv("ASYNC_TURNS_WORKERS", 32))
+    )
+
 # Listen for incoming requests on /api/messages.
 async def messages(req: Request) -> Response:
     # Parse incoming request
@@ -118,6 +165,17 @@ async def messages(req: Request) -> Response:
     activity = Activity().deserialize(body)
     auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
 
+    # Messages are queued once authenticated; replies are sent through the connector
+    # rather than the HTTP response. Invokes and expectReplies need a synchronous answer.
+    if turn_queue \
+        and activity.type == ActivityTypes.message \
+        and activity.delivery_mode != DeliveryModes.expect_replies:
+
+        authenticate_result = await adapter.bot_framework_authentication.authenticate_request(activity, auth_header)
+        if not turn_queue.try_enqueue(authenticate_result, activity):
+            return Response(status=HTTPStatus.SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+        return Response(status=HTTPStatus.ACCEPTED)
+
     # Route received a request to adapter for processing
     response = await adapter.process_activity(auth_header, activity, bot.on_turn)
     if response:
@@ -125,8 +183,63 @@ async def messages(req: Request) -> Response:
     return Response(status=HTTPStatus.OK)
 
 
+# Expose runtime metrics on /api/metrics.
+async def metrics(req: Request) -> Response:
+    if not hmac.compare_digest(req.headers.get("x-metrics-key", "").encode("utf-8"), os.getenv("METRICS_KEY").encode("utf-8")):
+        return Response(status=401)
+    data = {}
+    if turn_queue:
+        data["turn_queue"] = turn_queue.stats()
+    data["admission"] = bot.admission_controller.stats()
+    if aoai_transport:
+        data["aoai_backends"] = aoai_transport.stats()
+    if engine == "router":
+        data["router"] = bot.model_router.stats()
+    if getattr(bot, "response_cache", None):
+        data["response_cache"] = bot.response_cache.stats()
+    if getattr(bot, "search_retriever", None):
+        data["search"] = bot.search_retriever.stats()
+    if bot.sso_enabled:
+        data["sso_tokens"] = bot.token_cache.stats()
+    if engine == "assistant":
+        data["attachments"] = bot.attachment_ingestor.stats()
+        data["images"] = bot.image_cache.stats()
+        data["threads"] = bot.thread_pool.stats()
+    return json_response(data=data)
+
+
 app = web.Application(middlewares=[aiohttp_error_middleware])
 app.router.add_post("/api/messages", messages)
+# Metrics are only served when a key is configured, and callers must send it in the x-metrics-key header
+if os.getenv("METRICS_KEY"):
+    app.router.add_get("/api/metrics", metrics)
+
+async def on_startup(app: web.Application):
+    if turn_queue:
+        turn_queue.start()
+    if engine == "assistant":
+        bot.thread_pool.start()
+
+app.on_startup.append(on_startup)
+
+# Stop background work and release connections on shutdown
+async def on_cleanup(app: web.Application):
+    if turn_queue:
+        # Keep below gunicorn's graceful_timeout so accepted turns finish before the worker is killed
+        await turn_queue.stop(float(os.getenv("ASYNC_TURNS_SHUTDOWN_GRACE_SECONDS", 25)))
+    if phi_client:
+        await phi_client.close()
+    if sqlite_storage:
+        await sqlite_storage.close()
+    if getattr(bot, "search_retriever", None):
+        await bot.search_retriever.close()
+    await aoai_client.close()
+    await credential.close()
+    if engine == "assistant":
+        await bot.attachment_ingestor.close()
+        await bot.thread_pool.close()
+
+app.on_cleanup.append(on_cleanup)
 
 if __name__ == "__main__":
     try:
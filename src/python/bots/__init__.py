@@ -4,6 +4,7 @@
 from .assistant_bot import AssistantBot
 from .chat_completion_bot import ChatCompletionBot
 from .phi_bot import PhiBot
+from .router_bot import RouterBot
 from .semantic_kernel_bot import SemanticKernelBot
 
-__all__ = ["AssistantBot", "ChatCompletionBot", "PhiBot", "SemanticKernelBot"]
+__all__ = ["AssistantBot", "ChatCompletionBot", "PhiBot", "RouterBot", "SemanticKernelBot"]
@@ -2,25 +2,25 @@
 # Licensed under the MIT License.
 
 import os
-import io
+import sys
 import json
-import base64
-import urllib.request
+import asyncio
 
 from botbuilder.core import ConversationState, TurnContext, UserState, MessageFactory
 from botbuilder.schema import ChannelAccount, CardAction, ActionTypes, Activity
 from botbuilder.dialogs import Dialog
 
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, NotFoundError
 from openai.types.beta.assistant_stream_event import ThreadMessageDelta, ThreadRunRequiresAction, ThreadRunCreated, ThreadRunFailed
 from openai.types.beta.threads import TextDeltaBlock, ImageFileDeltaBlock
 
 from data_models import ConversationData, Attachment, mime_type
+from services import AttachmentIngestor, AttachmentTooLarge, ImageCache, ThreadPool
 from .state_management_bot import StateManagementBot
 
 class AssistantBot(StateManagementBot):
 
-    def __init__(self, conversation_state: ConversationState, user_state: UserState, aoai_client: AzureOpenAI, dialog: Dialog):
+    def __init__(self, conversation_state: ConversationState, user_state: UserState, aoai_client: AsyncAzureOpenAI, dialog: Dialog):
         super().__init__(conversation_state, user_state, dialog)
         self.aoai_client = aoai_client
         self.chat_client = aoai_client.chat
@@ -30,7 +30,25 @@ class AssistantBot(StateManagementBot):
         self.instructions = os.getenv("LLM_INSTRUCTIONS")
         self.welcome_message = os.getenv("LLM_WELCOME_MESSAGE", "Hello and welcome to the Assistant Bot Python!")
         self.assistant_id = os.getenv("AZURE_OPENAI_ASSISTANT_ID")
-        self.streaming = os.getenv("AZURE_OPENAI_STREAMING", False)
+        # Threads created ahead of time, so new conversations don't wait for one
+        self.thread_pool = ThreadPool(aoai_client, size=int(os.getenv("ASSISTANT_THREAD_POOL_SIZE", 4)))
+        self.attachment_ingestor = AttachmentIngestor(
+            aoai_client,
+            max_bytes=int(os.getenv("ATTACHMENT_MAX_BYTES", 50 * 1024 * 1024)),
+            spool_bytes=int(os.getenv("ATTACHMENT_SPOOL_BYTES", 1024 * 1024))
+        )
+        self.image_cache = ImageCache(
+            self.attachment_ingestor.download,
+            max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", 64)),
+            max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+        )
+        # Function tools the assistant can call, by name. Each takes the conversation
+        # data followed by the arguments declared in assistants_tools/.
+        self.tools = {
+            "image_query": self.image_query,
+        }
+        self.tool_timeout = float(os.getenv("ASSISTANT_TOOL_TIMEOUT_SECONDS", 60))
+        self.max_tool_rounds = int(os.getenv("ASSISTANT_MAX_TOOL_ROUNDS", 5))
 
     async def on_members_added_activity(self, members_added: list[ChannelAccount], turn_context: TurnContext):
         for member in members_added:
@@ -45,19 +63,17 @@ class AssistantBot(StateManagementBot):
             return False
         
         # Load conversation state
-        conversation_data = await self.conversation_data_accessor.get(turn_context, ConversationData([]))
+        conversation_data = await self.conversation_data_accessor.get(turn_context, self.create_conversation_data)
 
-        # Create a new thread if one does not exist
+        # Take a new thread from the pool if one does not exist
         if conversation_data.thread_id is None:
-            thread = self.aoai_client.beta.threads.create()
-            conversation_data.thread_id = thread.id
+            conversation_data.thread_id = await self.thread_pool.acquire()
 
-        # Delete thread if user asks
+        # Delete thread if user asks, and continue on a fresh one
         if turn_context.activity.text == 'clear':
-            self.aoai_client.beta.threads.delete(conversation_data.thread_id)
-            conversation_data.thread_id = None
-            conversation_data.attachments = []
-            conversation_data.history = []
+            await self.aoai_client.beta.threads.delete(conversation_data.thread_id)
+            conversation_data.thread_id = await self.thread_pool.acquire()
+            conversation_data.clear()
             await turn_context.send_activity('Conversation cleared!')
             return True
                 
@@ -74,11 +90,6 @@ class AssistantBot(StateManagementBot):
             tool = turn_context.activity.text.split(':').pop().strip()
             # Get file from attachments
             attachment = conversation_data.attachments[-1]
-            # Add file upload to relevant tool
-            with urllib.request.urlopen(attachment.url) as f:
-                bytes = io.BytesIO(f.read())
-                bytes.name = attachment.name
-            file_response = self.file_client.create(file=bytes, purpose="assistants")
             # Send the file to the assistant
             tools = []
             if tool == "Code Interpreter":
@@ -89,15 +100,19 @@ class AssistantBot(StateManagementBot):
                 tools.append({
                     "type": "file_search"
                 })
-            self.aoai_client.beta.threads.messages.create(
-                thread_id=conversation_data.thread_id,
-                role="user",
-                content=f"File uploaded: {attachment.name}",
-                attachments=[{
-                    "file_id": file_response.id,
-                    "tools": tools
-                }]
-            )
+            # Add file upload to relevant tool, reusing an earlier upload of the same file
+            try:
+                file_id = await self.attachment_ingestor.upload(attachment.name, attachment.url)
+                try:
+                    await self.add_file_message(conversation_data.thread_id, attachment.name, file_id, tools)
+                except NotFoundError:
+                    # The reused file was deleted, upload it again
+                    self.attachment_ingestor.invalidate(file_id)
+                    file_id = await self.attachment_ingestor.upload(attachment.name, attachment.url)
+                    await self.add_file_message(conversation_data.thread_id, attachment.name, file_id, tools)
+            except AttachmentTooLarge:
+                await turn_context.send_activity(f"{attachment.name} is too large to add to {tool}.")
+                return True
             # Send feedback to user
             await turn_context.send_activity(f"File added to {tool} successfully!");
             return True
@@ -106,14 +121,14 @@ class AssistantBot(StateManagementBot):
         conversation_data.add_turn("user", turn_context.activity.text)
         
         # Send user message to thread
-        self.aoai_client.beta.threads.messages.create(
+        await self.aoai_client.beta.threads.messages.create(
             thread_id=conversation_data.thread_id, 
             role="user", 
             content=turn_context.activity.text
         )
         
         # Run thread
-        run = self.aoai_client.beta.threads.runs.create(
+        run = await self.aoai_client.beta.threads.runs.create(
             thread_id=conversation_data.thread_id,
             assistant_id=self.assistant_id,
             instructions=self.instructions,
@@ -128,52 +143,80 @@ class AssistantBot(StateManagementBot):
     async def process_run_streaming(self, run, conversation_data, turn_context, stream_id = None):
         # Start streaming response
         current_message = ""
-        tool_outputs = []
         current_run_id = ""
-        activity_id = ""
-        stream_sequence = 1
-        activity_id = await self.send_interim_message(turn_context, "Typing...", stream_sequence, stream_id, "typing")
+        flusher = await self.start_stream(turn_context, stream_id)
+
+        # Each round streams the run until it completes or requires tool outputs
+        for tool_round in range(self.max_tool_rounds + 1):
+            tool_calls = []
+            async for event in run:
+                if type(event) == ThreadRunFailed:
+                    current_message = event.data.last_error.message
+                    break
+                if type(event) == ThreadRunCreated:
+                    current_run_id = event.data.id
+                if type(event) == ThreadRunRequiresAction:
+                    current_run_id = event.data.id
+                    tool_calls = event.data.required_action.submit_tool_outputs.tool_calls
+
+                if type(event) == ThreadMessageDelta:
+                    deltaBlock = event.data.delta.content[0]
+                    if type(deltaBlock) == TextDeltaBlock:
+                        current_message += deltaBlock.text.value
+                        flusher.update(current_message)
 
-        for event in run:
-            if type(event) == ThreadRunFailed:
-                current_message = event.data.last_error.message
+                    elif type(deltaBlock) == ImageFileDeltaBlock: 
+                        current_message += f"![{deltaBlock.image_file.file_id}](/api/files/{deltaBlock.image_file.file_id})"
+
+            if len(tool_calls) == 0:
                 break
-            if type(event) == ThreadRunCreated:
-                current_run_id = event.data.id
-            if type(event) == ThreadRunRequiresAction:
-                tool_calls = event.data.required_action.submit_tool_outputs.tool_calls
-                for tool_call in tool_calls:
-                    arguments = json.loads(tool_call.function.arguments)
-                    if tool_call.function.name == "image_query":
-                        response = await self.image_query(conversation_data, arguments["query"], arguments["image_name"])
-                        tool_outputs.append({"tool_call_id": tool_call.id, "output": response})
-
-            if type(event) == ThreadMessageDelta:
-                deltaBlock = event.data.delta.content[0]
-                if type(deltaBlock) == TextDeltaBlock:
-                    current_message += deltaBlock.text.value
-                    stream_sequence += 1
-                    # Flush content every 50 messages
-                    if (stream_sequence % 50 == 0):
-                        await self.send_interim_message(turn_context, current_message, stream_sequence, activity_id, "typing")
-
-                elif type(deltaBlock) == ImageFileDeltaBlock: 
-                    current_message += f"![{deltaBlock.image_file.file_id}](/api/files/{deltaBlock.image_file.file_id})"
-        
-        # Recursively process the run with the tool outputs
-        if len(tool_outputs) > 0:
-            new_run = self.aoai_client.beta.threads.runs.submit_tool_outputs(thread_id=conversation_data.thread_id, run_id=current_run_id, tool_outputs=tool_outputs, stream=True)
-            await self.process_run_streaming(new_run, conversation_data, turn_context, activity_id)
-            return
+            if tool_round == self.max_tool_rounds:
+                # Stop a run that keeps asking for tools instead of answering
+                await self.aoai_client.beta.threads.runs.cancel(thread_id=conversation_data.thread_id, run_id=current_run_id)
+                current_message += "\n\nI stopped because answering required too many tool calls."
+                break
+
+            # Continue the run with the outputs of all tool calls of this round
+            tool_outputs = await self.run_tool_calls(tool_calls, conversation_data)
+            run = await self.aoai_client.beta.threads.runs.submit_tool_outputs(thread_id=conversation_data.thread_id, run_id=current_run_id, tool_outputs=tool_outputs, stream=True)
+
         response = current_message
 
         # Add assistant message to history
         conversation_data.add_turn("assistant", response)
 
         # Respond back to user
-        stream_sequence += 1
-        await self.send_interim_message(turn_context, current_message, stream_sequence, activity_id, "message")
-    
+        await flusher.finish(current_message)
+
+    # Run the tool calls of one round concurrently. Failures and timeouts are
+    # reported to the assistant as the tool output so the run can still finish.
+    async def run_tool_calls(self, tool_calls, conversation_data: ConversationData):
+        async def run_tool_call(tool_call):
+            tool = self.tools.get(tool_call.function.name)
+            if tool is None:
+                return f"Unknown function {tool_call.function.name}"
+            try:
+                arguments = json.loads(tool_call.function.arguments or "{}")
+                return str(await asyncio.wait_for(tool(conversation_data, **arguments), self.tool_timeout))
+            except asyncio.TimeoutError:
+                return f"{tool_call.function.name} timed out after {self.tool_timeout} seconds"
+            except Exception as error:
+                print(f"\n [tool] {tool_call.function.name} failed: {error}", file=sys.stderr)
+                return f"{tool_call.function.name} failed: {error}"
+
+        outputs = await asyncio.gather(*[run_tool_call(tool_call) for tool_call in tool_calls])
+        return [{"tool_call_id": tool_call.id, "output": output} for tool_call, output in zip(tool_calls, outputs)]
+
+    async def add_file_message(self, thread_id: str, name: str, file_id: str, tools: list[dict]):
+        await self.aoai_client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=f"File uploaded: {name}",
+            attachments=[{
+                "file_id": file_id,
+                "tools": tools
+            }]
+        )
 
     # Helper to handle file uploads from user
     async def handle_file_uploads(self, turn_context: TurnContext, thread_id: str, conversation_data: ConversationData):
@@ -197,7 +240,7 @@ class AssistantBot(StateManagementBot):
                 # Add file upload notice to conversation history, frontend, and assistant
                 conversation_data.add_turn("user", f"File uploaded: {attachment.name}")
                 await turn_context.send_activity(f"File uploaded: {attachment.name}")
-                self.aoai_client.beta.threads.messages.create(thread_id=thread_id,role="user",content=f"File uploaded: {attachment.name}",)
+                await self.aoai_client.beta.threads.messages.create(thread_id=thread_id,role="user",content=f"File uploaded: {attachment.name}",)
                 # Ask whether to add file to a tool
                 await turn_context.send_activity(MessageFactory.suggested_actions(
                     [
@@ -213,25 +256,29 @@ class AssistantBot(StateManagementBot):
     
     async def image_query(self, conversation_data: ConversationData, query: str, image_name: str):
         # Find image in attachments by name
-        image = next(filter(lambda a: a.name == image_name.split("/")[-1], conversation_data.attachments))
+        image_name = image_name.split("/")[-1]
+        image = next((a for a in reversed(conversation_data.attachments) if a.name == image_name), None)
         # Handle image not found
+        if image is None:
+            images = [a.name for a in conversation_data.attachments if a.content_type and a.content_type.startswith("image/")]
+            return f"Image {image_name} was not found. Uploaded images: {', '.join(images) or 'none'}"
 
-        # Read image.url
-        with urllib.request.urlopen(image.url) as f:
-            # get file as base64
-            bytes = base64.b64encode(f.read()).decode()
+        # Get the downsized image, downloading it only once per worker
+        try:
+            data_url = await self.image_cache.get(image.url)
+        except Exception as error:
+            return f"Image {image_name} could not be read: {error}"
 
         # Send image to assistant
-        response = self.chat_client.completions.create(
+        response = await self.chat_client.completions.create(
             model=self.deployment,
             messages=[
                 {"role": "user", "content": [
                     {"type": "text", "text": query},
                     {"type": "image_url", "image_url": {
-                        "url": f"data:{image.content_type};base64,{bytes}"}
+                        "url": data_url}
                     }
                 ]}
             ]
         )
         return response.choices[0].message.content
-
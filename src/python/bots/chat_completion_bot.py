@@ -2,22 +2,48 @@
 # Licensed under the MIT License.
 
 import os
+from azure.core.credentials import AzureKeyCredential
+from azure.identity.aio import DefaultAzureCredential
 from botbuilder.core import ConversationState, TurnContext, UserState
 from botbuilder.schema import ChannelAccount
 from botbuilder.dialogs import Dialog
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 
-from data_models import ConversationData
+from services import ResponseCache, SearchRetriever, Summarizer
 from .state_management_bot import StateManagementBot
-from utils import get_citations_card, replace_citations
+from utils import get_citations_card, replace_citations, replace_citations_streaming
 
 
 class ChatCompletionBot(StateManagementBot):
 
-    def __init__(self, conversation_state: ConversationState, user_state: UserState, aoai_client: AzureOpenAI, dialog: Dialog):
+    def __init__(self, conversation_state: ConversationState, user_state: UserState, aoai_client: AsyncAzureOpenAI, dialog: Dialog):
         super().__init__(conversation_state, user_state, dialog)
         self._aoai_client = aoai_client
         self.welcome_message = os.getenv("LLM_WELCOME_MESSAGE", "Hello and welcome to the Chat Completion Bot Python!")
+        if self.summarize:
+            self.summarizer = Summarizer(self.create_summary)
+        # Reuse answers to repeated questions, e.g. the same first question in new conversations
+        self.response_cache = None
+        if os.getenv("RESPONSE_CACHE_ENABLED", "false") != "false":
+            self.response_cache = ResponseCache(
+                max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000)),
+                ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600)),
+                max_messages=int(os.getenv("RESPONSE_CACHE_MAX_MESSAGES", 3)),
+                embed=self.create_embedding if os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME") else None,
+                similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.95))
+            )
+        # Query the search index from the bot instead of passing it to Azure OpenAI as a data source
+        self.search_retriever = None
+        if os.getenv("AZURE_SEARCH_API_ENDPOINT") and os.getenv("AZURE_SEARCH_MODE", "server") == "client":
+            self.search_retriever = SearchRetriever(
+                os.getenv("AZURE_SEARCH_API_ENDPOINT"),
+                os.getenv("AZURE_SEARCH_INDEX"),
+                AzureKeyCredential(os.getenv("AZURE_SEARCH_API_KEY")) if os.getenv("AZURE_SEARCH_API_KEY") \
+                    else DefaultAzureCredential(managed_identity_client_id=os.getenv("MicrosoftAppId")),
+                top=int(os.getenv("AZURE_SEARCH_TOP", 5)),
+                max_tokens=int(os.getenv("AZURE_SEARCH_MAX_TOKENS", 2000)),
+                cache_ttl_seconds=float(os.getenv("AZURE_SEARCH_CACHE_TTL_SECONDS", 300))
+            )
 
     async def on_members_added_activity(self, members_added: list[ChannelAccount], turn_context: TurnContext):
         for member in members_added:
@@ -26,14 +52,15 @@ class ChatCompletionBot(StateManagementBot):
 
     async def on_message_activity(self, turn_context: TurnContext):
         # Load conversation state
-        conversation_data = await self.conversation_data_accessor.get(turn_context, ConversationData([]))
+        conversation_data = await self.conversation_data_accessor.get(turn_context, self.create_conversation_data)
 
         # Add user message to history
         conversation_data.add_turn("user", turn_context.activity.text)
+        self.start_compaction(turn_context, conversation_data)
         
         # Run logic to obtain response
         extra_body = {}
-        if os.getenv("AZURE_SEARCH_API_ENDPOINT"):
+        if os.getenv("AZURE_SEARCH_API_ENDPOINT") and not self.search_retriever:
             extra_body['data_sources'] = [
                     {
                         "type": "azure_search",
@@ -50,25 +77,101 @@ class ChatCompletionBot(StateManagementBot):
                     }
                 ]
 
-        completion = self._aoai_client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-            messages=conversation_data.toMessages(),
-            extra_body=extra_body
-        )
+        cache_lookup = None
+        if self.response_cache:
+            cache_lookup = await self.response_cache.lookup(
+                conversation_data.toMessages(),
+                os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+                os.getenv("AZURE_SEARCH_INDEX")
+            )
+
+        messages = conversation_data.toMessages()
+        citations = None
+        if self.search_retriever and not (cache_lookup and cache_lookup.entry):
+            citations = await self.search_retriever.retrieve(turn_context.activity.text)
+            messages = self.search_retriever.build_messages(messages, citations)
+
+        if cache_lookup and cache_lookup.entry:
+            response = cache_lookup.entry.response
+            context = cache_lookup.entry.context
+
+            # Respond back to user
+            await turn_context.send_activity(response)
+        elif self.streaming:
+            response, context = await self.process_completion_streaming(messages, extra_body, turn_context)
+        else:
+            completion = await self._aoai_client.chat.completions.create(
+                model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+                messages=messages,
+                extra_body=extra_body
+            )
+            response = completion.choices[0].message.content
+            response = replace_citations(response)
+            context = getattr(completion.choices[0].message, "context", None)
+
+            # Respond back to user
+            await turn_context.send_activity(response)
 
-        response = completion.choices[0].message.content
-        response = replace_citations(response)
+        if citations:
+            context = {"citations": citations}
+
+        if self.response_cache:
+            self.response_cache.store(cache_lookup, response, context)
 
         # Add assistant message to history
         conversation_data.add_turn("assistant", response)
 
-        # Respond back to user
-        await turn_context.send_activity(response)
-
         # Send citations if they exist
         if  os.getenv("AZURE_SEARCH_API_ENDPOINT") \
-            and 'citations' in completion.choices[0].message.context \
-            and len(completion.choices[0].message.context['citations']) > 0:
+            and context \
+            and 'citations' in context \
+            and len(context['citations']) > 0:
 
-            citations = completion.choices[0].message.context['citations']
+            citations = context['citations']
             await turn_context.send_activity(get_citations_card(citations))
+
+    async def create_summary(self, messages: list[dict]):
+        completion = await self._aoai_client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            messages=messages
+        )
+        return completion.choices[0].message.content
+
+    async def create_embedding(self, text: str):
+        embedding = await self._aoai_client.embeddings.create(
+            model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"),
+            input=text
+        )
+        return embedding.data[0].embedding
+
+    async def process_completion_streaming(self, messages: list[dict], extra_body: dict, turn_context: TurnContext):
+        # Start streaming response
+        current_message = ""
+        context = None
+        flusher = await self.start_stream(turn_context, format=replace_citations_streaming)
+
+        completion = await self._aoai_client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            messages=messages,
+            extra_body=extra_body,
+            stream=True
+        )
+
+        async for chunk in completion:
+            # Azure OpenAI sends content filter results in chunks without choices
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            # On your data returns citations in the context of the first delta
+            if getattr(delta, "context", None) and 'citations' in delta.context:
+                context = delta.context
+            if delta.content:
+                current_message += delta.content
+                flusher.update(current_message)
+
+        response = replace_citations(current_message)
+
+        # Respond back to user
+        await flusher.finish(response)
+
+        return response, context
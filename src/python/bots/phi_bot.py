@@ -7,7 +7,7 @@ from botbuilder.core import ConversationState, TurnContext, UserState
 from botbuilder.schema import ChannelAccount
 from botbuilder.dialogs import Dialog
 
-from services import Phi
+from services import Phi, Summarizer
 from data_models import ConversationData
 from .state_management_bot import StateManagementBot
 
@@ -17,6 +17,8 @@ class PhiBot(StateManagementBot):
         super().__init__(conversation_state, user_state, dialog)
         self._phi_client = phi_client
         self.welcome_message = os.getenv("LLM_WELCOME_MESSAGE", "Hello and welcome to the Phi Bot Python!")
+        if self.summarize:
+            self.summarizer = Summarizer(self.create_summary)
 
     async def on_members_added_activity(self, members_added: list[ChannelAccount], turn_context: TurnContext):
         for member in members_added:
@@ -25,19 +27,55 @@ class PhiBot(StateManagementBot):
 
     async def on_message_activity(self, turn_context: TurnContext):
         # Load conversation state
-        conversation_data = await self.conversation_data_accessor.get(turn_context, ConversationData([]))
+        conversation_data = await self.conversation_data_accessor.get(turn_context, self.create_conversation_data)
 
         # Add user message to history
         conversation_data.add_turn("user", turn_context.activity.text)
+        self.start_compaction(turn_context, conversation_data)
         
         # Run logic to obtain response
-        completion = self._phi_client.create_completion(
+        response = await self.generate_response(conversation_data, turn_context)
+
+        # Add assistant message to history
+        conversation_data.add_turn("assistant", response)
+
+    # Answer from the history and send the reply, without touching the state.
+    # RouterBot calls this for turns it sends to Phi.
+    async def generate_response(self, conversation_data: ConversationData, turn_context: TurnContext):
+        if self.streaming:
+            return await self.process_completion_streaming(conversation_data, turn_context)
+
+        completion = await self._phi_client.create_completion(
             messages=conversation_data.toMessages()
         )
         response = completion["choices"][0]["message"]["content"]
 
-        # Add assistant message to history
-        conversation_data.add_turn("assistant", response)
+        # Respond back to user
+        await turn_context.send_activity(response)
+        return response
+
+    async def create_summary(self, messages: list[dict]):
+        completion = await self._phi_client.create_completion(
+            messages=messages
+        )
+        return completion["choices"][0]["message"]["content"]
+
+    async def process_completion_streaming(self, conversation_data: ConversationData, turn_context: TurnContext):
+        # Start streaming response
+        current_message = ""
+        flusher = await self.start_stream(turn_context)
+
+        async for chunk in self._phi_client.create_completion_streaming(
+            messages=conversation_data.toMessages()
+        ):
+            if len(chunk.get("choices", [])) == 0:
+                continue
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                current_message += content
+                flusher.update(current_message)
 
         # Respond back to user
-        return await turn_context.send_activity(response)
+        await flusher.finish(current_message)
+
+        return current_message
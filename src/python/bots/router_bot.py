@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+from botbuilder.core import ConversationState, TurnContext, UserState
+from botbuilder.dialogs import Dialog
+from openai import AsyncAzureOpenAI
+
+from services import ModelRouter, Phi
+from services.model_router import LARGE, SMALL
+from .chat_completion_bot import ChatCompletionBot
+from .phi_bot import PhiBot
+
+# Sends easy turns to the Phi deployment and hard ones to Azure OpenAI chat completions
+class RouterBot(ChatCompletionBot):
+
+    def __init__(self, conversation_state: ConversationState, user_state: UserState, aoai_client: AsyncAzureOpenAI, phi_client: Phi, dialog: Dialog):
+        super().__init__(conversation_state, user_state, aoai_client, dialog)
+        self.welcome_message = os.getenv("LLM_WELCOME_MESSAGE", "Hello and welcome to the Router Bot Python!")
+        # Only generates the Phi replies. History, compaction and the conversation
+        # locks stay with this bot, so turns on both tiers are serialized together.
+        self._phi_bot = PhiBot(conversation_state, user_state, phi_client, dialog)
+        self.model_router = ModelRouter(
+            threshold=float(os.getenv("ROUTER_THRESHOLD", 1.0)),
+            prompt_tokens=int(os.getenv("ROUTER_PROMPT_TOKENS", 150)),
+            history_tokens=int(os.getenv("ROUTER_HISTORY_TOKENS", 2000)),
+            small_concurrency=int(os.getenv("ROUTER_PHI_MAX_CONCURRENCY", 32)),
+            large_concurrency=int(os.getenv("ROUTER_AOAI_MAX_CONCURRENCY", 32))
+        )
+
+    async def on_message_activity(self, turn_context: TurnContext):
+        # Load conversation state
+        conversation_data = await self.conversation_data_accessor.get(turn_context, self.create_conversation_data)
+
+        # Retrieval-grounded answers and attachments need the larger model, even when it is busy
+        required = bool(turn_context.activity.attachments) or bool(os.getenv("AZURE_SEARCH_API_ENDPOINT"))
+        if required:
+            tier = LARGE
+        else:
+            tier = self.model_router.classify(turn_context.activity.text, False, conversation_data.get_history_tokens())
+
+        async with self.model_router.acquire(tier, fallback=not required) as tier:
+            if tier == SMALL:
+                conversation_data.add_turn("user", turn_context.activity.text)
+                self.start_compaction(turn_context, conversation_data)
+                response = await self._phi_bot.generate_response(conversation_data, turn_context)
+                conversation_data.add_turn("assistant", response)
+                return
+            return await super().on_message_activity(turn_context)
@@ -1,10 +1,21 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 import os
-import jwt
+import sys
+import json
+import time
+import uuid
+import asyncio
 from botbuilder.core import ActivityHandler, ConversationState, TurnContext, UserState, MessageFactory
 from botbuilder.dialogs import Dialog, DialogSet, DialogTurnStatus
+from botbuilder.schema import ActivityTypes
 from botframework.connector.auth.user_token_client import UserTokenClient
+from jsonpickle.pickler import Pickler
+
+from data_models import ConversationData
+from services import AdmissionController, AdmissionRejected, StreamFlusher, TokenCache
+from services.stream_flusher import CHANNEL_MIN_INTERVALS
+from utils import KeyedLock
 
 
 class StateManagementBot(ActivityHandler):
@@ -19,14 +30,262 @@ class StateManagementBot(ActivityHandler):
             self.sso_enabled = False
         print(self.sso_enabled)
         self.sso_config_name = os.getenv("SSO_CONFIG_NAME", "default")
-
+        # Validated SSO tokens, so signed-in users skip the token service until shortly before expiry.
+        # Logout bumps the session version in the user profile, which every worker
+        # checks before using its cached token. The TTL still bounds how long a
+        # token revoked outside the bot is accepted.
+        self.token_cache = TokenCache(
+            refresh_margin=float(os.getenv("SSO_TOKEN_REFRESH_MARGIN_SECONDS", 300)),
+            max_ttl=float(os.getenv("SSO_TOKEN_CACHE_TTL_SECONDS", 3600))
+        )
+        self.dialog_set = DialogSet(self.conversation_state.create_property("DialogState"))
+        self.dialog_set.add(self.dialog)
+        self.streaming = os.getenv("AZURE_OPENAI_STREAMING", False)
+        if (self.streaming == "false"):
+            self.streaming = False
+        self.stream_flush_interval = float(os.getenv("STREAM_FLUSH_INTERVAL_SECONDS", 0.5))
+        self.stream_flush_max_interval = float(os.getenv("STREAM_FLUSH_MAX_INTERVAL_SECONDS", 2))
+        self.stream_flush_min_chars = int(os.getenv("STREAM_FLUSH_MIN_CHARS", 20))
+        self.max_turns = int(os.getenv("MAX_TURNS", 10))
+        self.max_tokens = int(os.getenv("MAX_HISTORY_TOKENS", 4000))
+        self.summarize = os.getenv("SUMMARIZE_HISTORY", False)
+        if (self.summarize == "false"):
+            self.summarize = False
+        # Bots that support history compaction set a Summarizer here. Evicted turns
+        # are summarized in batches once they reach either threshold.
+        self.summarizer = None
+        self.compaction_turns = int(os.getenv("COMPACTION_MIN_TURNS", 6))
+        self.compaction_tokens = int(os.getenv("COMPACTION_MIN_TOKENS", 1000))
+        self.compactions = {}
+        # Turns of one conversation run one at a time within this worker
+        self.conversation_locks = KeyedLock()
+        self.save_retries = int(os.getenv("STATE_SAVE_RETRIES", 3))
+        # Drop messages the channel redelivers while or after we process them,
+        # by remembering the ids of this many latest messages per conversation
+        self.idempotency_window = int(os.getenv("IDEMPOTENCY_WINDOW", 50))
+        # A message being processed is claimed in the shared storage for this long,
+        # so a redelivery to another worker is dropped. A turn that failed or whose
+        # worker died can run again once its claim expires.
+        self.idempotency_lease = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", 300))
+        # Limit concurrent and per-user/per-tenant message turns hitting the LLM backends
+        self.admission_controller = AdmissionController(
+            max_concurrency=int(os.getenv("MAX_CONCURRENT_TURNS", 32)),
+            timeout=float(os.getenv("ADMISSION_TIMEOUT_SECONDS", 10)),
+            user_rate_per_minute=float(os.getenv("USER_RATE_PER_MINUTE", 0)),
+            tenant_rate_per_minute=float(os.getenv("TENANT_RATE_PER_MINUTE", 0)),
+            burst=float(os.getenv("RATE_LIMIT_BURST", 5))
+        )
+        self.busy_message = os.getenv("LLM_BUSY_MESSAGE", "I'm handling a lot of requests right now. Please try again in a moment.")
 
     async def on_turn(self, turn_context: TurnContext):
-        await super().on_turn(turn_context)
-        # Save any state changes. The load happened during the execution of the Dialog.
-        await self.conversation_state.save_changes(turn_context)
-        await self.user_state.save_changes(turn_context)
+        async with self.conversation_locks.acquire(turn_context.activity.conversation.id):
+            conversation_data = None
+            claim = None
+            if self.idempotency_window > 0 \
+                and turn_context.activity.type == ActivityTypes.message \
+                and turn_context.activity.id:
+                conversation_data = await self.conversation_data_accessor.get(turn_context, self.create_conversation_data)
+                if conversation_data.has_activity(turn_context.activity.id):
+                    return
+                claim = await self.claim_activity(turn_context)
+                if claim is None:
+                    return
+            try:
+                if turn_context.activity.type == ActivityTypes.message:
+                    try:
+                        async with self.admission_controller.admit(
+                            turn_context.activity.from_property.id if turn_context.activity.from_property else None,
+                            turn_context.activity.conversation.tenant_id
+                        ):
+                            await super().on_turn(turn_context)
+                    except AdmissionRejected:
+                        if claim is not None:
+                            await self.release_activity(turn_context, claim)
+                        await turn_context.send_activity(self.busy_message)
+                        return
+                else:
+                    await super().on_turn(turn_context)
+                # Only a turn that completed is marked as processed, so a redelivery of a failed turn runs again
+                if conversation_data is not None:
+                    conversation_data.record_activity(turn_context.activity.id, self.idempotency_window)
+                # Save any state changes. The load happened during the execution of the Dialog.
+                await self.save_state(turn_context)
+            except BaseException:
+                # Let a redelivery retry the failed turn now instead of after the lease
+                if claim is not None:
+                    await self.release_activity(turn_context, claim)
+                raise
+
+    # Write changed conversation and user state together in a single storage call.
+    # If another worker saved the same state since it was loaded, the ETag check
+    # fails and this turn's changes are rebased onto the stored state and retried.
+    async def save_state(self, turn_context: TurnContext):
+        changes = {}
+        saved = []
+        for state in (self.conversation_state, self.user_state):
+            cached_state = state.get_cached_state(turn_context)
+            if cached_state is None:
+                continue
+            if not cached_state.is_changed:
+                continue
+            changes[state.get_storage_key(turn_context)] = cached_state
+            saved.append(cached_state)
+        if not changes:
+            return
+
+        storage = self.conversation_state._storage
+        for attempt in range(self.save_retries + 1):
+            try:
+                await storage.write({key: cached_state.state for key, cached_state in changes.items()})
+                break
+            except Exception as error:
+                if attempt == self.save_retries or not self.is_etag_conflict(error):
+                    raise
+                current = await storage.read(list(changes.keys()))
+                for key, cached_state in list(changes.items()):
+                    # Storages that write key by key may have saved part of the batch
+                    if self.is_same_state(cached_state.state, current.get(key)):
+                        del changes[key]
+                        continue
+                    cached_state.state = self.rebase_state(cached_state.state, current.get(key))
+                if not changes:
+                    break
+        for cached_state in saved:
+            cached_state.hash = cached_state.compute_hash(cached_state.state)
+
+    # Claim the message in the shared storage with an ETag-conditional write, so
+    # only one worker runs it. Claims of a conversation live in one document next
+    # to its state and are kept until they expire; completed messages are then
+    # remembered by ConversationData. Returns the claim owner, or None when the
+    # message is already claimed.
+    async def claim_activity(self, turn_context: TurnContext):
+        storage = self.conversation_state._storage
+        key = self.get_claims_key(turn_context)
+        activity_id = turn_context.activity.id
+        owner = uuid.uuid4().hex
+        for attempt in range(self.save_retries + 1):
+            document = (await storage.read([key])).get(key)
+            now = time.time()
+            claims = {
+                claimed_id: claim for claimed_id, claim in (document or {}).get("claims", {}).items()
+                if claim["expires_at"] > now
+            }
+            if activity_id in claims:
+                return None
+            claims[activity_id] = {"owner": owner, "expires_at": now + self.idempotency_lease}
+            try:
+                await storage.write({key: {"claims": claims, "e_tag": document.get("e_tag", "*") if document else "*"}})
+            except Exception as error:
+                if attempt == self.save_retries or not self.is_etag_conflict(error):
+                    raise
+                continue
+            if document is not None:
+                return owner
+            # Storages can't create an item only if it is missing, so make sure
+            # a concurrent first claim didn't overwrite this one
+            current = (await storage.read([key])).get(key)
+            if current is not None and current.get("claims", {}).get(activity_id, {}).get("owner") == owner:
+                return owner
+        return None
+
+    async def release_activity(self, turn_context: TurnContext, owner: str):
+        storage = self.conversation_state._storage
+        key = self.get_claims_key(turn_context)
+        activity_id = turn_context.activity.id
+        try:
+            for attempt in range(self.save_retries + 1):
+                document = (await storage.read([key])).get(key)
+                if document is None or document.get("claims", {}).get(activity_id, {}).get("owner") != owner:
+                    return
+                claims = {claimed_id: claim for claimed_id, claim in document["claims"].items() if claimed_id != activity_id}
+                try:
+                    await storage.write({key: {"claims": claims, "e_tag": document.get("e_tag", "*")}})
+                    return
+                except Exception as error:
+                    if attempt == self.save_retries or not self.is_etag_conflict(error):
+                        raise
+        except Exception as error:
+            # The claim still expires after the lease
+            print(f"\n [idempotency] failed to release claim: {error}", file=sys.stderr)
+
+    def get_claims_key(self, turn_context: TurnContext):
+        return f"{self.conversation_state.get_storage_key(turn_context)}/claims"
+
+    @staticmethod
+    def is_etag_conflict(error: Exception):
+        # Cosmos DB fails the write with 412 Precondition Failed, local storages raise KeyError
+        return isinstance(error, KeyError) or getattr(error, "status_code", None) == 412
+
+    @staticmethod
+    def is_same_state(state: dict, current: dict):
+        if current is None:
+            return False
+        # Compare the same flattened form BotState hashes to detect changes
+        flatten = lambda item: json.dumps(Pickler().flatten({key: value for key, value in item.items() if key != "e_tag"}), sort_keys=True, default=str)
+        return flatten(state) == flatten(current)
+
+    @staticmethod
+    def rebase_state(state: dict, current: dict):
+        if current is None:
+            return {**state, "e_tag": "*"}
+        rebased = {**state, "e_tag": current.get("e_tag", "*")}
+        if isinstance(state.get("ConversationData"), ConversationData) and isinstance(current.get("ConversationData"), ConversationData):
+            rebased["ConversationData"] = state["ConversationData"].rebase(current["ConversationData"])
+        # Never undo a logout saved concurrently by another worker
+        if isinstance(state.get("UserProfile"), dict) and isinstance(current.get("UserProfile"), dict):
+            session = max(state["UserProfile"].get("session", 0), current["UserProfile"].get("session", 0))
+            if session > 0:
+                rebased["UserProfile"] = {**state["UserProfile"], "session": session}
+        return rebased
     
+    def create_conversation_data(self):
+        return ConversationData([], self.max_turns, max_tokens=self.max_tokens, summarize=self.summarizer is not None)
+
+    # Summarize a batch of turns evicted from the history window in the background.
+    # The turn does not wait for it, the summary is saved to the conversation state
+    # once it is ready and applies from the next turn on.
+    def start_compaction(self, turn_context: TurnContext, conversation_data: ConversationData):
+        conversation_data.summarize = self.summarizer is not None
+        if self.summarizer is None:
+            return
+        turns = list(conversation_data.evicted)
+        if len(turns) < min(self.compaction_turns, conversation_data.max_turns) \
+            and sum(turn.tokens for turn in turns) < self.compaction_tokens:
+            return
+        conversation_id = turn_context.activity.conversation.id
+        if conversation_id in self.compactions:
+            return
+        task = asyncio.create_task(self.compact(
+            conversation_id,
+            self.conversation_state.get_storage_key(turn_context),
+            conversation_data.summary,
+            turns
+        ))
+        self.compactions[conversation_id] = task
+        task.add_done_callback(lambda _: self.compactions.pop(conversation_id, None))
+
+    async def compact(self, conversation_id: str, storage_key: str, summary: str, turns: list):
+        try:
+            summary = await self.summarizer.summarize(summary, turns)
+            # Write after the turn in progress has saved its state, then merge with whatever is stored
+            async with self.conversation_locks.acquire(conversation_id):
+                storage = self.conversation_state._storage
+                for attempt in range(self.save_retries + 1):
+                    items = await storage.read([storage_key])
+                    state = items.get(storage_key)
+                    if state is None or not isinstance(state.get("ConversationData"), ConversationData):
+                        return
+                    state["ConversationData"].apply_summary(summary, turns)
+                    try:
+                        await storage.write({storage_key: state})
+                        return
+                    except Exception as error:
+                        if attempt == self.save_retries or not self.is_etag_conflict(error):
+                            raise
+        except Exception as error:
+            # The turns stay evicted, so the next batch retries them
+            print(f"\n [compaction] summarization failed: {error}", file=sys.stderr)
+
     async def handle_login(self, turn_context: TurnContext):
         if not self.sso_enabled:
             return True
@@ -34,30 +293,50 @@ class StateManagementBot(ActivityHandler):
             await self.handle_logout(turn_context)
             return False
 
-        user_profile_accessor = self.user_state.create_property("UserProfile")
-        user_profile = await user_profile_accessor.get(turn_context, lambda: {})
-
-        user_token_client = turn_context.turn_state.get(UserTokenClient.__name__, None)
+        user_profile = await self.user_profile_accessor.get(turn_context, lambda: {})
 
+        user_id = turn_context.activity.from_property.id
+        channel_id = turn_context.activity.channel_id
         try:
-            user_token = await user_token_client.get_user_token(turn_context.activity.from_property.id, self.sso_config_name, turn_context.activity.channel_id, None)
-            decoded_token = jwt.decode(user_token.token, options={"verify_signature": False})
-            user_profile["name"] = decoded_token.get("name")
+            session = user_profile.get("session", 0)
+            decoded_token = self.token_cache.get(user_id, channel_id, session)
+            if decoded_token is None:
+                user_token_client = turn_context.turn_state.get(UserTokenClient.__name__, None)
+                user_token = await user_token_client.get_user_token(user_id, self.sso_config_name, channel_id, None)
+                decoded_token = self.token_cache.set(user_id, channel_id, user_token.token, session)
+            if user_profile.get("name") != decoded_token.get("name"):
+                user_profile["name"] = decoded_token.get("name")
             return True
         except Exception as error:
-            dialog_set = DialogSet(self.conversation_state.create_property("DialogState"))
-            dialog_set.add(self.dialog)
-            dialog_context = await dialog_set.create_context(turn_context)
+            dialog_context = await self.dialog_set.create_context(turn_context)
             results = await dialog_context.continue_dialog()
             if results.status == DialogTurnStatus.Empty:
                 await dialog_context.begin_dialog(self.dialog.id)
             return False
 
     async def handle_logout(self, turn_context):
+        user_profile = await self.user_profile_accessor.get(turn_context, lambda: {})
+        user_profile["session"] = user_profile.get("session", 0) + 1
+        self.token_cache.invalidate(turn_context.activity.from_property.id, turn_context.activity.channel_id)
         user_token_client = turn_context.turn_state.get(UserTokenClient.__name__, None)
         await user_token_client.sign_out_user(turn_context.activity.from_property.id, self.sso_config_name, turn_context.activity.channel_id)
         await turn_context.send_activity("Signed out")
 
+    # Send the typing indicator of a streamed reply and return the flusher that
+    # sends its partial output. format is applied to partial text before sending.
+    async def start_stream(self, turn_context: TurnContext, stream_id: str = None, format=None):
+        stream_sequence = 1
+        activity_id = await self.send_interim_message(turn_context, "Typing...", stream_sequence, stream_id, "typing")
+        return StreamFlusher(
+            lambda text, stream_sequence, stream_type: self.send_interim_message(turn_context, text, stream_sequence, activity_id, stream_type),
+            activity_id,
+            stream_sequence,
+            format,
+            min_interval=max(self.stream_flush_interval, CHANNEL_MIN_INTERVALS.get(turn_context.activity.channel_id, 0)),
+            max_interval=self.stream_flush_max_interval,
+            min_chars=self.stream_flush_min_chars
+        )
+
     async def send_interim_message(
         self,
         turn_context,
@@ -25,9 +25,12 @@ class TemplateBot(StateManagementBot):
 
     async def on_message_activity(self, turn_context: TurnContext):
         # Load conversation state
-        conversation_data = await self.conversation_data_accessor.get(turn_context, ConversationData([
-            ConversationTurn("system", self._instructions)
-        ]))
+        conversation_data = await self.conversation_data_accessor.get(turn_context, ConversationData(
+            [],
+            self.max_turns,
+            max_tokens=self.max_tokens,
+            pinned=[ConversationTurn("system", self._instructions)]
+        ))
 
         # Catch any special messages here
 
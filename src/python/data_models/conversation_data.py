@@ -1,19 +1,54 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import os
+import json
+import zlib
+import base64
+from collections import deque
+
+# Version of the compact state format written by ConversationData.__getstate__
+STATE_VERSION = 1
+# Encoded state larger than STATE_COMPRESSION_THRESHOLD bytes (default 2048) is
+# stored zlib-compressed. It is read on use, since this module is imported
+# before app.py loads the .env file.
+DEFAULT_COMPRESSION_THRESHOLD = 2048
+
+ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+# Rough token estimate (~4 characters per token plus per-message overhead).
+# It only needs to be cheap and stable, since it bounds the prompt window
+# rather than billing it.
+def estimate_tokens(content: str) -> int:
+    return 4 + (len(content) + 3) // 4 if content else 4
+
 class ConversationTurn:
+    __slots__ = ("role", "content", "tokens")
+
     def __init__(
         self,
         role: str = None,
-        content: str = None
+        content: str = None,
+        tokens: int = None
     ):
         self.role = role
         self.content = content
+        self.tokens = tokens if tokens is not None else estimate_tokens(content)
 
     def toJSON(self):
         return {"role": self.role, "content": self.content}
 
+    def encode(self):
+        return [ROLE_CODES.get(self.role, self.role), self.content, self.tokens]
+
+    @staticmethod
+    def decode(state: list):
+        return ConversationTurn(ROLE_NAMES.get(state[0], state[0]), state[1], state[2])
+
 class Attachment:
+    __slots__ = ("name", "content_type", "url")
+
     def __init__(
         self,
         name: str = None,
@@ -24,22 +59,199 @@ class Attachment:
         self.content_type = content_type
         self.url = url
 
+    def encode(self):
+        return [self.name, self.content_type, self.url]
+
+    @staticmethod
+    def decode(state: list):
+        return Attachment(*state)
+
 class ConversationData:
+    __slots__ = (
+        "thread_id", "history", "history_tokens", "max_turns", "max_tokens",
+        "pinned", "attachments", "summary", "summarize", "evicted", "activity_ids", "_new_turns"
+    )
+
     def __init__(
         self,
         history: list[ConversationTurn],
         max_turns: int = 10,
         thread_id: str = None,
+        max_tokens: int = None,
+        pinned: list[ConversationTurn] = None,
+        summarize: bool = False,
     ):
         self.thread_id = thread_id
-        self.history = history
+        self.history = deque()
+        self.history_tokens = 0
         self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.pinned = list(pinned or [])
         self.attachments = []
+        # Rolling summary of turns that fell out of the window, and turns
+        # evicted since the summary was last updated
+        self.summary = None
+        self.summarize = summarize
+        self.evicted = []
+        # Ids of the latest processed message activities, to drop channel redeliveries
+        self.activity_ids = []
+        # Turns added since the state was loaded, used to rebase on a concurrent write
+        self._new_turns = []
+        for turn in history:
+            self._append(turn)
+
+    # Persist a versioned state with short keys, compressed when it is large
+    def __getstate__(self):
+        self._upgrade()
+        state = {
+            "v": STATE_VERSION,
+            "t": self.thread_id,
+            "mt": self.max_turns,
+            "mk": self.max_tokens,
+            "h": [turn.encode() for turn in self.history],
+            "p": [turn.encode() for turn in self.pinned],
+            "a": [attachment.encode() for attachment in self.attachments],
+            "s": self.summary,
+            "sz": self.summarize,
+            "e": [turn.encode() for turn in self.evicted],
+            "ai": self.activity_ids,
+        }
+        encoded = json.dumps(state, separators=(",", ":"))
+        if len(encoded) > int(os.getenv("STATE_COMPRESSION_THRESHOLD", DEFAULT_COMPRESSION_THRESHOLD)):
+            return {"v": STATE_VERSION, "z": base64.b64encode(zlib.compress(encoded.encode("utf-8"))).decode("ascii")}
+        return state
+
+    def __setstate__(self, state):
+        # State written before the compact format is a plain attribute dictionary
+        if "v" not in state:
+            for key, value in state.items():
+                setattr(self, key, value)
+            self._upgrade()
+            return
+        if "z" in state:
+            state = json.loads(zlib.decompress(base64.b64decode(state["z"])))
+        self.thread_id = state.get("t")
+        self.max_turns = state.get("mt", 10)
+        self.max_tokens = state.get("mk")
+        self.history = deque(ConversationTurn.decode(turn) for turn in state.get("h", []))
+        self.history_tokens = sum(turn.tokens for turn in self.history)
+        self.pinned = [ConversationTurn.decode(turn) for turn in state.get("p", [])]
+        self.attachments = [Attachment.decode(attachment) for attachment in state.get("a", [])]
+        self.summary = state.get("s")
+        self.summarize = state.get("sz", False)
+        self.evicted = [ConversationTurn.decode(turn) for turn in state.get("e", [])]
+        self.activity_ids = state.get("ai", [])
+        self._new_turns = []
 
     def add_turn(self, role: str, content: str):
-        self.history.append(ConversationTurn(role, content))
-        if len(self.history) >= self.max_turns:
-            self.history.pop(0)
+        self._upgrade()
+        turn = ConversationTurn(role, content)
+        self._new_turns.append(turn)
+        self._append(turn)
+
+    def pin_turn(self, role: str, content: str):
+        self._upgrade()
+        self.pinned.append(ConversationTurn(role, content))
+        self._evict()
+
+    def clear(self):
+        self._upgrade()
+        self.history.clear()
+        self.history_tokens = 0
+        self.attachments = []
+        self.summary = None
+        self.evicted = []
+
+    # Store a summary that includes the given evicted turns, and stop tracking them
+    def apply_summary(self, summary: str, turns: list[ConversationTurn]):
+        self._upgrade()
+        summarized = [(turn.role, turn.content) for turn in turns]
+        remaining = []
+        for turn in self.evicted:
+            if (turn.role, turn.content) in summarized:
+                summarized.remove((turn.role, turn.content))
+            else:
+                remaining.append(turn)
+        self.evicted = remaining
+        self.summary = summary
+        self._evict()
+
+    def has_activity(self, activity_id: str):
+        self._upgrade()
+        return activity_id in self.activity_ids
+
+    def record_activity(self, activity_id: str, limit: int):
+        self._upgrade()
+        self.activity_ids.append(activity_id)
+        del self.activity_ids[:max(0, len(self.activity_ids) - limit)]
+
+    def get_history_tokens(self):
+        self._upgrade()
+        return self.history_tokens
 
     def toMessages(self):
-        return [turn.toJSON() for turn in self.history]
+        self._upgrade()
+        messages = [turn.toJSON() for turn in self.pinned]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        return messages + [turn.toJSON() for turn in self.history]
+
+    # Re-apply the changes made since loading on top of state that was saved
+    # concurrently by another turn, and return the merged state
+    def rebase(self, current: "ConversationData"):
+        self._upgrade()
+        current._upgrade()
+        for turn in self._new_turns:
+            current._append(turn)
+        current._new_turns = list(self._new_turns)
+        known_urls = {attachment.url for attachment in current.attachments}
+        current.attachments.extend(attachment for attachment in self.attachments if attachment.url not in known_urls)
+        if current.thread_id is None:
+            current.thread_id = self.thread_id
+        if current.summary is None:
+            current.summary = self.summary
+        current.activity_ids.extend(activity_id for activity_id in self.activity_ids if activity_id not in current.activity_ids)
+        return current
+
+    def _append(self, turn: ConversationTurn):
+        self.history.append(turn)
+        self.history_tokens += turn.tokens
+        self._evict()
+
+    def _evict(self):
+        # Drop the oldest turns until the window fits both the turn limit and
+        # the token budget left after pinned turns and the summary. The latest turn is always kept.
+        budget = None
+        if self.max_tokens is not None:
+            budget = self.max_tokens - sum(turn.tokens for turn in self.pinned)
+            if self.summary:
+                budget -= estimate_tokens(self.summary)
+        while len(self.history) > 1 and (
+            len(self.history) > self.max_turns
+            or (budget is not None and self.history_tokens > budget)
+        ):
+            turn = self.history.popleft()
+            self.history_tokens -= turn.tokens
+            if self.summarize:
+                self.evicted.append(turn)
+        # Cap pending turns in case summarization keeps failing
+        if len(self.evicted) > self.max_turns:
+            del self.evicted[:len(self.evicted) - self.max_turns]
+
+    def _upgrade(self):
+        # State saved before the compact format may be missing newer attributes,
+        # store history as a plain list and have turns without token counts
+        if isinstance(getattr(self, "history", None), deque) and hasattr(self, "activity_ids"):
+            return
+        for name, default in (
+            ("thread_id", None), ("history", []), ("max_turns", 10), ("max_tokens", None),
+            ("pinned", []), ("attachments", []), ("summary", None), ("summarize", False), ("evicted", []),
+            ("activity_ids", []), ("_new_turns", [])
+        ):
+            if not hasattr(self, name):
+                setattr(self, name, default)
+        for turn in list(self.history) + self.pinned + self.evicted:
+            if getattr(turn, "tokens", None) is None:
+                turn.tokens = estimate_tokens(turn.content)
+        self.history = deque(self.history)
+        self.history_tokens = sum(turn.tokens for turn in self.history)
@@ -7,6 +7,8 @@ bind = "0.0.0.0:3978"
 
 timeout = 230
 # https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
+# Leaves time for queued turns to drain on shutdown, see ASYNC_TURNS_SHUTDOWN_GRACE_SECONDS
+graceful_timeout = 30
 
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
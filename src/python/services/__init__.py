@@ -1,6 +1,18 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+from .admission_controller import AdmissionController, AdmissionRejected
+from .attachment_ingestor import AttachmentIngestor, AttachmentTooLarge
+from .image_cache import ImageCache
+from .load_balancing_transport import Backend, LoadBalancingTransport
+from .model_router import ModelRouter
 from .phi import Phi
+from .response_cache import ResponseCache
+from .search_retriever import SearchRetriever
+from .stream_flusher import StreamFlusher
+from .summarizer import Summarizer
+from .thread_pool import ThreadPool
+from .token_cache import TokenCache
+from .turn_queue import TurnQueue
 
-__all__ = ["Phi"]
+__all__ = ["AdmissionController", "AdmissionRejected", "AttachmentIngestor", "AttachmentTooLarge", "Backend", "ImageCache", "LoadBalancingTransport", "ModelRouter", "Phi", "ResponseCache", "SearchRetriever", "StreamFlusher", "Summarizer", "ThreadPool", "TokenCache", "TurnQueue"]
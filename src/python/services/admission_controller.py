@@ -0,0 +1,115 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+class AdmissionRejected(Exception):
+    pass
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    # Takes a token and returns 0, or returns how long until one is available
+    def take(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+
+    def __init__(
+            self,
+            max_concurrency: int = 32,
+            timeout: float = 10,
+            user_rate_per_minute: float = 0,
+            tenant_rate_per_minute: float = 0,
+            burst: float = 5,
+            max_buckets: int = 10000
+    ):
+        self._max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self._timeout = timeout
+        self._user_rate = user_rate_per_minute / 60
+        self._tenant_rate = tenant_rate_per_minute / 60
+        self._burst = burst
+        self._max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+
+    # Waits for a rate limit token and a concurrency slot, giving up with
+    # AdmissionRejected if both are not available within the timeout
+    @asynccontextmanager
+    async def admit(self, user_id: str = None, tenant_id: str = None):
+        started_at = time.monotonic()
+        deadline = started_at + self._timeout
+        self.waiting += 1
+        try:
+            if user_id and self._user_rate > 0:
+                await self._take_token(f"user:{user_id}", self._user_rate, deadline)
+            if tenant_id and self._tenant_rate > 0:
+                await self._take_token(f"tenant:{tenant_id}", self._tenant_rate, deadline)
+            if self._semaphore is not None:
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise AdmissionRejected()
+        finally:
+            self.waiting -= 1
+
+        self.admitted += 1
+        self._total_wait += time.monotonic() - started_at
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def stats(self):
+        return {
+            "max_concurrency": self._max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "utilization": self.in_flight / self._max_concurrency if self._max_concurrency > 0 else 0.0,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "average_wait_seconds": self._total_wait / self.admitted if self.admitted else 0.0,
+        }
+
+    async def _take_token(self, key: str, rate: float, deadline: float):
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, self._burst, now)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self._max_buckets:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+
+        wait = bucket.take(now)
+        if wait == 0:
+            return
+        if now + wait > deadline:
+            self.rejected += 1
+            raise AdmissionRejected()
+        # Reserve the token that becomes available after the wait
+        bucket.tokens -= 1
+        await asyncio.sleep(wait)
@@ -0,0 +1,129 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import aiohttp
+from openai import AsyncAzureOpenAI
+
+class AttachmentTooLarge(Exception):
+    pass
+
+# Uploads user attachments to Azure OpenAI for the assistant tools. Downloads
+# are streamed into a temporary file that only spills to disk above spool_bytes,
+# and are aborted above max_bytes. Uploaded files are remembered by URL and by
+# content hash, so the same document is uploaded once per worker no matter how
+# many conversations share it.
+class AttachmentIngestor:
+
+    def __init__(
+            self,
+            aoai_client: AsyncAzureOpenAI,
+            max_bytes: int = 50 * 1024 * 1024,
+            spool_bytes: int = 1024 * 1024,
+            max_entries: int = 1000,
+            timeout: float = 120,
+            chunk_size: int = 64 * 1024
+    ):
+        self._file_client = aoai_client.files
+        self._max_bytes = max_bytes
+        self._spool_bytes = spool_bytes
+        self._max_entries = max_entries
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._chunk_size = chunk_size
+        self._file_ids_by_url = OrderedDict()
+        self._file_ids_by_hash = OrderedDict()
+        self._pending = {}
+        self._session = None
+        self.reused = 0
+        self.uploaded = 0
+
+    # The session is created lazily so it binds to the running event loop
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self._timeout)
+        return self._session
+
+    # Streams the file at url into a spooled temporary file and returns it
+    # rewound, together with the SHA-256 of its content. The caller closes the file.
+    async def download(self, url: str):
+        file = tempfile.SpooledTemporaryFile(max_size=self._spool_bytes)
+        content_hash = hashlib.sha256()
+        size = 0
+        try:
+            async with self._get_session().get(url) as response:
+                response.raise_for_status()
+                if response.content_length is not None and response.content_length > self._max_bytes:
+                    raise AttachmentTooLarge(f"Attachment is larger than {self._max_bytes} bytes")
+                async for chunk in response.content.iter_chunked(self._chunk_size):
+                    size += len(chunk)
+                    if size > self._max_bytes:
+                        raise AttachmentTooLarge(f"Attachment is larger than {self._max_bytes} bytes")
+                    content_hash.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return file, content_hash.hexdigest()
+
+    # Returns the id of an Azure OpenAI file with the attachment's content
+    async def upload(self, name: str, url: str) -> str:
+        file_id = self._get(self._file_ids_by_url, url)
+        if file_id is not None:
+            self.reused += 1
+            return file_id
+
+        file, content_hash = await self.download(url)
+        try:
+            file_id = self._get(self._file_ids_by_hash, content_hash)
+            if file_id is not None:
+                self.reused += 1
+            else:
+                # Concurrent uploads of the same content wait for the first one
+                pending = self._pending.get(content_hash)
+                if pending is None:
+                    pending = asyncio.ensure_future(self._file_client.create(file=(name, file), purpose="assistants"))
+                    self._pending[content_hash] = pending
+                    pending.add_done_callback(lambda _: self._pending.pop(content_hash, None))
+                    self.uploaded += 1
+                else:
+                    self.reused += 1
+                file_id = (await asyncio.shield(pending)).id
+                self._put(self._file_ids_by_hash, content_hash, file_id)
+        finally:
+            file.close()
+        self._put(self._file_ids_by_url, url, file_id)
+        return file_id
+
+    # Forget a file id, e.g. after the file was deleted from Azure OpenAI
+    def invalidate(self, file_id: str):
+        for entries in (self._file_ids_by_url, self._file_ids_by_hash):
+            for key in [key for key, value in entries.items() if value == file_id]:
+                del entries[key]
+
+    def stats(self):
+        return {
+            "files": len(self._file_ids_by_hash),
+            "uploaded": self.uploaded,
+            "reused": self.reused,
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _get(self, entries: OrderedDict, key: str):
+        file_id = entries.get(key)
+        if file_id is not None:
+            entries.move_to_end(key)
+        return file_id
+
+    def _put(self, entries: OrderedDict, key: str, file_id: str):
+        entries[key] = file_id
+        entries.move_to_end(key)
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import io
+import asyncio
+import base64
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from PIL import ExifTags, Image, ImageOps
+
+# The vision models scale images to fit in 2048x2048 and then to 768 pixels on
+# the shortest side before counting tokens, so larger images only cost bandwidth
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+
+# Downloads, downsizes and base64-encodes images for vision requests, keeping
+# the encoded payload per URL in a LRU bounded by entry count and total size.
+# Concurrent requests for the same image share one download.
+class ImageCache:
+
+    def __init__(
+            self,
+            download: Callable[[str], Awaitable],
+            max_entries: int = 64,
+            max_bytes: int = 32 * 1024 * 1024,
+            quality: int = 85
+    ):
+        self._download = download
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._quality = quality
+        self._size = 0
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Returns a data URL for the image at url
+    async def get(self, url: str) -> str:
+        data_url = self._entries.get(url)
+        if data_url is not None:
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return data_url
+
+        self.misses += 1
+        pending = self._pending.get(url)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(url))
+            self._pending[url] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(url, None))
+        data_url = await asyncio.shield(pending)
+
+        if url not in self._entries and len(data_url) <= self._max_bytes:
+            self._entries[url] = data_url
+            self._size += len(data_url)
+            while len(self._entries) > self._max_entries or self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return data_url
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def _load(self, url: str) -> str:
+        file, _ = await self._download(url)
+        try:
+            # Decoding and resizing are CPU bound, keep them off the event loop
+            content_type, content = await asyncio.get_running_loop().run_in_executor(None, self._preprocess, file)
+        finally:
+            file.close()
+        return f"data:{content_type};base64,{base64.b64encode(content).decode()}"
+
+    def _preprocess(self, file) -> tuple[str, bytes]:
+        original = file.read()
+        image = Image.open(io.BytesIO(original))
+        original_type = Image.MIME.get(image.format)
+        # Animated images are sent as their first frame
+        image.seek(0)
+        # Phone photos are often stored sideways with an EXIF orientation
+        rotated = image.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        image = ImageOps.exif_transpose(image)
+
+        scale = min(1.0, MAX_SIDE / max(image.size))
+        if min(image.size) * scale > SHORT_SIDE:
+            scale = SHORT_SIDE / min(image.size)
+        if scale < 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+        output = io.BytesIO()
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if has_alpha:
+            content_type = "image/png"
+            image.save(output, format="PNG", optimize=True)
+        else:
+            content_type = "image/jpeg"
+            image.convert("RGB").save(output, format="JPEG", quality=self._quality, optimize=True)
+
+        # Small upright images may already be encoded more compactly than we can
+        if scale == 1.0 and not rotated and original_type and len(output.getvalue()) >= len(original):
+            return original_type, original
+        return content_type, output.getvalue()
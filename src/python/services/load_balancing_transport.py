@@ -0,0 +1,216 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import re
+import time
+import asyncio
+import httpx
+
+# Requests to the balanced deployment can go to any backend. Other deployments
+# (e.g. embeddings) and everything else, such as assistants, threads and files,
+# stay on the primary endpoint because those resources only exist there.
+DEPLOYMENT_PATH = re.compile(r"^.*?/openai/deployments/([^/]+)(/.*)$")
+
+# Answers that mean the backend itself is misconfigured (wrong key, endpoint or
+# deployment name), so it is taken out of rotation for longer than on throttling
+UNHEALTHY_STATUS_CODES = (401, 403, 404)
+
+class Backend:
+    __slots__ = (
+        "endpoint", "deployment", "api_key", "unavailable_until", "failures",
+        "remaining_requests", "remaining_tokens", "limits_updated_at", "in_flight",
+        "responded", "unhealthy", "last_selected"
+    )
+
+    def __init__(self, endpoint: str, deployment: str, api_key: str = None):
+        self.endpoint = httpx.URL(endpoint)
+        self.deployment = deployment
+        self.api_key = api_key
+        self.unavailable_until = 0.0
+        self.failures = 0
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.limits_updated_at = 0.0
+        self.in_flight = 0
+        self.responded = False
+        self.unhealthy = False
+        self.last_selected = 0
+
+    def stats(self):
+        return {
+            "available": self.unavailable_until <= time.monotonic(),
+            "unhealthy": self.unhealthy,
+            "failures": self.failures,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "in_flight": self.in_flight,
+        }
+
+# httpx transport for the Azure OpenAI client that spreads requests to one
+# deployment (the first backend's by default) over several endpoints/deployments.
+# Backends that have not answered yet are tried first. After that it prefers the
+# backend with the most remaining quota according to the x-ratelimit headers, or
+# the one with the fewest requests in flight when some backends don't send them.
+# A backend is taken out of rotation for its Retry-After period (or an
+# exponential backoff) when it answers 429/5xx or cannot be reached, and for
+# unhealthy_backoff when it answers 401/403/404, and the request is retried on
+# another one.
+class LoadBalancingTransport(httpx.AsyncBaseTransport):
+
+    def __init__(
+            self,
+            backends: list[Backend],
+            transport: httpx.AsyncBaseTransport = None,
+            max_backoff: float = 30,
+            max_wait: float = 60,
+            deployment: str = None,
+            unhealthy_backoff: float = 300
+    ):
+        self._backends = backends
+        self._deployment = deployment or backends[0].deployment
+        self._transport = transport or httpx.AsyncHTTPTransport()
+        self._max_backoff = max_backoff
+        self._max_wait = max_wait
+        self._unhealthy_backoff = unhealthy_backoff
+        self._selections = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        match = DEPLOYMENT_PATH.match(request.url.path)
+        if match is None or match.group(1) != self._deployment:
+            return await self._transport.handle_async_request(request)
+
+        deadline = time.monotonic() + self._max_wait
+        content = await request.aread()
+        last_response = None
+        last_error = None
+        # Backends that rejected this request as misconfigured are not asked again
+        rejected = set()
+        while True:
+            now = time.monotonic()
+            candidates = [backend for backend in self._backends if backend not in rejected]
+            if len(candidates) == 0:
+                return last_response
+            backend = self._select(candidates, now)
+            if backend is None:
+                # Every backend is cooling down, wait for the first one to come back
+                waiting = [backend for backend in candidates if not backend.unhealthy] or candidates
+                wait = min(backend.unavailable_until for backend in waiting) - now
+                if now + wait <= deadline:
+                    await asyncio.sleep(wait)
+                    continue
+                # Unhealthy backends are still asked as a last resort, so their real error reaches the client
+                unhealthy = [backend for backend in candidates if backend.unhealthy]
+                if len(unhealthy) > 0:
+                    backend = min(unhealthy, key=lambda backend: backend.last_selected)
+                elif last_response is not None:
+                    return last_response
+                elif last_error is not None:
+                    raise last_error
+                else:
+                    # Nothing was sent, answer like a throttled backend so the client reports it
+                    return httpx.Response(
+                        429,
+                        headers={"retry-after": str(max(1, round(wait))), "content-type": "application/json"},
+                        json={"error": {"code": "429", "message": "All backends are throttled, retry later."}},
+                        request=request
+                    )
+
+            self._selections += 1
+            backend.last_selected = self._selections
+            backend.in_flight += 1
+            try:
+                response = await self._transport.handle_async_request(self._rewrite(request, content, backend, match.group(2)))
+            except httpx.TransportError as error:
+                self._trip(backend, None)
+                last_error = error
+                continue
+            finally:
+                backend.in_flight -= 1
+
+            backend.responded = True
+            self._record_limits(backend, response.headers)
+            if response.status_code in UNHEALTHY_STATUS_CODES:
+                self._trip(backend, self._unhealthy_backoff)
+                backend.unhealthy = True
+                rejected.add(backend)
+                await response.aread()
+                await response.aclose()
+                last_response = response
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                self._trip(backend, self._retry_after(response.headers))
+                await response.aread()
+                await response.aclose()
+                last_response = response
+                continue
+
+            backend.failures = 0
+            backend.unhealthy = False
+            return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    # Backends are reported by position in the configuration, without endpoints or deployment names
+    def stats(self):
+        return [{"backend": i, **backend.stats()} for i, backend in enumerate(self._backends)]
+
+    def _select(self, candidates: list[Backend], now: float):
+        available = [backend for backend in candidates if backend.unavailable_until <= now]
+        if len(available) == 0:
+            return None
+        # Probe backends that have not answered yet
+        probes = [backend for backend in available if not backend.responded]
+        if len(probes) > 0:
+            return min(probes, key=lambda backend: (backend.in_flight, backend.last_selected))
+        # Rate limit windows are per minute, so older readings no longer apply
+        for backend in available:
+            if now - backend.limits_updated_at > 60:
+                backend.remaining_requests = None
+                backend.remaining_tokens = None
+        # Without quota readings from every backend they can't be compared, so
+        # spread the load by requests in flight, least recently used first
+        if any(backend.remaining_tokens is None and backend.remaining_requests is None for backend in available):
+            return min(available, key=lambda backend: (backend.in_flight, backend.last_selected))
+        return max(available, key=lambda backend: (
+            backend.remaining_tokens if backend.remaining_tokens is not None else float("inf"),
+            backend.remaining_requests if backend.remaining_requests is not None else float("inf"),
+            -backend.in_flight
+        ))
+
+    def _rewrite(self, request: httpx.Request, content: bytes, backend: Backend, operation: str):
+        path = f"{backend.endpoint.path.rstrip('/')}/openai/deployments/{backend.deployment}{operation}"
+        url = request.url.copy_with(scheme=backend.endpoint.scheme, host=backend.endpoint.host, port=backend.endpoint.port, path=path)
+        headers = [(name, value) for name, value in request.headers.raw if name.lower() not in (b"host", b"content-length")]
+        if backend.api_key:
+            headers = [(name, value) for name, value in headers if name.lower() not in (b"api-key", b"authorization")]
+            headers.append((b"api-key", backend.api_key.encode("ascii")))
+        return httpx.Request(request.method, url, headers=headers, content=content, extensions=request.extensions)
+
+    def _trip(self, backend: Backend, retry_after: float):
+        backend.failures += 1
+        if retry_after is None:
+            retry_after = min(self._max_backoff, 0.5 * 2 ** (backend.failures - 1))
+        backend.unavailable_until = time.monotonic() + retry_after
+
+    @staticmethod
+    def _retry_after(headers: httpx.Headers):
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return None
+
+    @staticmethod
+    def _record_limits(backend: Backend, headers: httpx.Headers):
+        try:
+            if "x-ratelimit-remaining-requests" in headers:
+                backend.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            if "x-ratelimit-remaining-tokens" in headers:
+                backend.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            backend.limits_updated_at = time.monotonic()
+        except ValueError:
+            pass
@@ -0,0 +1,72 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import re
+import asyncio
+from contextlib import asynccontextmanager
+
+from data_models.conversation_data import estimate_tokens
+
+SMALL = "small"
+LARGE = "large"
+
+# Requests that usually need the larger model
+COMPLEX_PATTERNS = re.compile(
+    r"\b(why|explain|analy[sz]e|compare|summari[sz]e|step[- ]by[- ]step|calculate|plan|write|code|debug|translate)\b",
+    re.IGNORECASE
+)
+
+class ModelRouter:
+
+    def __init__(
+            self,
+            threshold: float = 1.0,
+            prompt_tokens: int = 150,
+            history_tokens: int = 2000,
+            small_concurrency: int = 32,
+            large_concurrency: int = 32
+    ):
+        self._threshold = threshold
+        self._prompt_tokens = prompt_tokens
+        self._history_tokens = history_tokens
+        self._slots = {
+            SMALL: asyncio.Semaphore(small_concurrency),
+            LARGE: asyncio.Semaphore(large_concurrency),
+        }
+        self.routed = {SMALL: 0, LARGE: 0}
+        self.fallbacks = 0
+
+    # Higher scores mean the turn is harder. Each feature contributes roughly
+    # in proportion to how far past its "easy" limit the turn is.
+    def score(self, text: str, has_attachments: bool, history_tokens: int) -> float:
+        text = text or ""
+        score = estimate_tokens(text) / self._prompt_tokens
+        score += 0.5 * history_tokens / self._history_tokens
+        score += min(len(COMPLEX_PATTERNS.findall(text)), 2) * 0.4
+        if "```" in text:
+            score += 1
+        if has_attachments:
+            score += 1
+        return score
+
+    def classify(self, text: str, has_attachments: bool, history_tokens: int) -> str:
+        return LARGE if self.score(text, has_attachments, history_tokens) >= self._threshold else SMALL
+
+    # Holds a slot on the chosen tier. If fallback is allowed, falls back to the
+    # other tier when the preferred one is saturated and the other still has capacity.
+    @asynccontextmanager
+    async def acquire(self, tier: str, fallback: bool = True):
+        other = LARGE if tier == SMALL else SMALL
+        if fallback and self._slots[tier].locked() and not self._slots[other].locked():
+            tier = other
+            self.fallbacks += 1
+        async with self._slots[tier]:
+            self.routed[tier] += 1
+            yield tier
+
+    def stats(self):
+        return {
+            "routed_small": self.routed[SMALL],
+            "routed_large": self.routed[LARGE],
+            "fallbacks": self.fallbacks,
+        }
@@ -1,29 +1,70 @@
-import requests
+import json
+import aiohttp
 
 class Phi:
 
     def __init__(
             self,
             deployment_endpoint: str,
-            deployment_key: str
+            deployment_key: str,
+            timeout: float = 120,
+            connect_timeout: float = 10,
+            max_connections: int = 100
     ):
         self._deployment_endpoint = deployment_endpoint
         self._deployment_key = deployment_key
+        self._timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self._max_connections = max_connections
+        self._session = None
 
-    def create_completion(
+    # The session is created lazily so it binds to the running event loop,
+    # and is reused so every request shares the same keep-alive connection pool
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_connections),
+                timeout=self._timeout,
+                headers={
+                    "Authorization": f"Bearer {self._deployment_key}"
+                }
+            )
+        return self._session
+
+    async def create_completion(
             self,
             messages: list[dict]
     ):
-        response = requests.post(
+        async with self._get_session().post(
             f"{self._deployment_endpoint}",
-            headers={
-                "Authorization": f"Bearer {self._deployment_key}"
-            },
             json={
                 "messages": messages
             }
-        )
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
 
-        response.raise_for_status()
+    async def create_completion_streaming(
+            self,
+            messages: list[dict]
+    ):
+        async with self._get_session().post(
+            f"{self._deployment_endpoint}",
+            json={
+                "messages": messages,
+                "stream": True
+            }
+        ) as response:
+            response.raise_for_status()
+            # Parse server-sent events, one "data: {...}" line per chunk
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
 
-        return response.json()
\ No newline at end of file
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,152 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import re
+import sys
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import numpy as np
+
+# Only case, whitespace and sentence punctuation at the end are ignored, since
+# symbols change the meaning of questions like "2+2", "C++" or "3.5"
+def normalize(text: str) -> str:
+    return re.sub(r"[\s.?!,;:]+$", "", re.sub(r"\s+", " ", (text or "").lower()).strip())
+
+def digest(value: object) -> str:
+    return hashlib.sha256(json.dumps(value, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class CacheEntry:
+    __slots__ = ("key", "scope", "response", "context", "embedding", "created_at")
+
+    def __init__(self, key: str, scope: str, response: str, context: dict, embedding: np.ndarray, created_at: float):
+        self.key = key
+        self.scope = scope
+        self.response = response
+        self.context = context
+        self.embedding = embedding
+        self.created_at = created_at
+
+class CacheLookup:
+    __slots__ = ("key", "scope", "embedding", "entry")
+
+    def __init__(self, key: str, scope: str, embedding: np.ndarray = None, entry: CacheEntry = None):
+        self.key = key
+        self.scope = scope
+        self.embedding = embedding
+        self.entry = entry
+
+# Caches completions by the normalized message window, deployment and search index.
+# Lookups try an exact match first and then, if an embedding function is given,
+# the most similar cached last question among entries with the same earlier
+# messages. Entries expire after the TTL and are evicted least recently used first.
+class ResponseCache:
+
+    def __init__(
+            self,
+            max_entries: int = 1000,
+            ttl_seconds: float = 3600,
+            max_messages: int = 3,
+            embed: Callable[[str], Awaitable[list[float]]] = None,
+            similarity_threshold: float = 0.95
+    ):
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._max_messages = max_messages
+        self._embed = embed
+        self._similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns None when the window is too long to be worth caching
+    async def lookup(self, messages: list[dict], deployment: str, index: str) -> CacheLookup:
+        if len(messages) == 0 or len(messages) > self._max_messages:
+            return None
+        normalized = [[message["role"], normalize(message["content"])] for message in messages]
+        lookup = CacheLookup(digest([deployment, index, normalized]), digest([deployment, index, normalized[:-1]]))
+
+        now = time.monotonic()
+        entry = self._entries.get(lookup.key)
+        if entry is not None and now - entry.created_at > self._ttl_seconds:
+            self._remove(entry)
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(entry.key)
+            self.exact_hits += 1
+            lookup.entry = entry
+            return lookup
+
+        if self._embed is not None:
+            # An embedding failure only costs the semantic tier, never the turn
+            try:
+                lookup.embedding = self._unit(await self._embed(messages[-1]["content"]))
+            except Exception as error:
+                print(f"\n [response cache] embedding failed: {error}", file=sys.stderr)
+            entry = self._most_similar(lookup, now) if lookup.embedding is not None else None
+            if entry is not None:
+                self._entries.move_to_end(entry.key)
+                self.semantic_hits += 1
+                lookup.entry = entry
+                return lookup
+
+        self.misses += 1
+        return lookup
+
+    def store(self, lookup: CacheLookup, response: str, context: dict):
+        if lookup is None or lookup.entry is not None or not response:
+            return
+        existing = self._entries.get(lookup.key)
+        if existing is not None:
+            self._remove(existing)
+        entry = CacheEntry(lookup.key, lookup.scope, response, context, lookup.embedding, time.monotonic())
+        self._entries[entry.key] = entry
+        self._scopes.setdefault(entry.scope, OrderedDict())[entry.key] = entry
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries.values())))
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _most_similar(self, lookup: CacheLookup, now: float):
+        scope = self._scopes.get(lookup.scope)
+        if not scope:
+            return None
+        candidates = [
+            entry for entry in scope.values()
+            if entry.embedding is not None and now - entry.created_at <= self._ttl_seconds
+        ]
+        if len(candidates) == 0:
+            return None
+        similarities = np.stack([entry.embedding for entry in candidates]) @ lookup.embedding
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= self._similarity_threshold else None
+
+    def _remove(self, entry: CacheEntry):
+        self._entries.pop(entry.key, None)
+        scope = self._scopes.get(entry.scope)
+        if scope is not None:
+            scope.pop(entry.key, None)
+            if len(scope) == 0:
+                del self._scopes[entry.scope]
+
+    @staticmethod
+    def _unit(vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else array
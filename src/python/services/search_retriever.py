@@ -0,0 +1,144 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+from azure.search.documents.aio import SearchClient
+
+from data_models.conversation_data import estimate_tokens
+from .response_cache import normalize
+
+GROUNDING_INSTRUCTIONS = (
+    "Answer using only the retrieved documents below. Cite the documents you use with their "
+    "reference, for example [doc1]. If the documents do not contain the answer, say that you don't know."
+)
+
+# Queries an Azure AI Search index directly, as an alternative to passing it to
+# Azure OpenAI as a data source. Results are cached per normalized query, and
+# concurrent identical queries share a single request. Chunks are deduplicated
+# and trimmed to a token budget before they are added to the prompt.
+class SearchRetriever:
+
+    def __init__(
+            self,
+            endpoint: str,
+            index_name: str,
+            credential,
+            top: int = 5,
+            max_tokens: int = 2000,
+            cache_max_entries: int = 500,
+            cache_ttl_seconds: float = 300,
+            content_field: str = "content",
+            title_field: str = "title",
+            url_field: str = "url"
+    ):
+        self._endpoint = endpoint
+        self._index_name = index_name
+        self._credential = credential
+        self._top = top
+        self._max_tokens = max_tokens
+        self._cache = OrderedDict()
+        self._cache_max_entries = cache_max_entries
+        self._cache_ttl_seconds = cache_ttl_seconds
+        self._content_field = content_field
+        self._title_field = title_field
+        self._url_field = url_field
+        self._pending = {}
+        self._client = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # The client is created lazily so it binds to the running event loop
+    def _get_client(self):
+        if self._client is None:
+            self._client = SearchClient(self._endpoint, self._index_name, self._credential)
+        return self._client
+
+    # Returns citations in the shape Azure OpenAI uses for its data sources,
+    # so they render with get_citations_card
+    async def retrieve(self, query: str) -> list[dict]:
+        key = normalize(query)
+        if not key:
+            return []
+
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] <= self._cache_ttl_seconds:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return cached[1]
+
+        self.cache_misses += 1
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._search(query))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        citations = await asyncio.shield(pending)
+
+        self._cache[key] = (time.monotonic(), citations)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_max_entries:
+            self._cache.popitem(last=False)
+        return citations
+
+    # Add the retrieved documents as a system message before the latest user message
+    def build_messages(self, messages: list[dict], citations: list[dict]) -> list[dict]:
+        if len(citations) == 0:
+            return messages
+        documents = "\n\n".join(
+            f"[doc{i+1}] {citation['title'] or ''}\n{citation['content']}"
+            for i, citation in enumerate(citations)
+        )
+        grounding = {"role": "system", "content": f"{GROUNDING_INSTRUCTIONS}\n\n{documents}"}
+        return messages[:-1] + [grounding] + messages[-1:]
+
+    def stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "entries": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+        }
+
+    # The retriever owns its credential and closes it with the client
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if hasattr(self._credential, "close"):
+            await self._credential.close()
+
+    async def _search(self, query: str) -> list[dict]:
+        results = await self._get_client().search(search_text=query, top=self._top)
+        citations = []
+        seen = set()
+        budget = self._max_tokens
+        async for document in results:
+            content = document.get(self._content_field)
+            if not content:
+                continue
+            # Overlapping chunks of the same document often repeat verbatim
+            fingerprint = hashlib.sha1(normalize(content).encode("utf-8")).hexdigest()
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            tokens = estimate_tokens(content)
+            if tokens > budget:
+                # Keep a truncated first chunk rather than no grounding at all
+                if len(citations) > 0 or budget <= 0:
+                    break
+                content = content[:budget * 4]
+                tokens = budget
+            budget -= tokens
+            citations.append({
+                "title": document.get(self._title_field),
+                "url": document.get(self._url_field),
+                "filepath": document.get("filepath"),
+                "chunk_id": document.get("chunk_id"),
+                "content": content,
+            })
+        return citations
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import time
+import asyncio
+from typing import Awaitable, Callable
+
+# Lowest allowed seconds between interim updates per channel, applied on top of
+# the configured interval. Teams throttles update_activity per conversation,
+# Direct Line streaming is cheap.
+CHANNEL_MIN_INTERVALS = {
+    "msteams": 1.5,
+    "directline": 0.25,
+}
+
+# Decides when partial output of a streamed reply is sent to the channel.
+# An update is sent once min_interval has passed since the last one and either
+# min_chars new characters arrived or max_interval has passed. Sends run in the
+# background, one at a time, and only the latest text is sent, so a slow
+# channel never blocks the stream and superseded updates are dropped.
+class StreamFlusher:
+
+    def __init__(
+            self,
+            send: Callable[[str, int, str], Awaitable],
+            stream_id: str,
+            stream_sequence: int = 1,
+            format: Callable[[str], str] = None,
+            min_interval: float = 0.5,
+            max_interval: float = 2.0,
+            min_chars: int = 20
+    ):
+        self._send = send
+        self._stream_id = stream_id
+        self._format = format
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._min_chars = min_chars
+        self.stream_sequence = stream_sequence
+        self._text = ""
+        self._sent_length = 0
+        self._sent_at = time.monotonic()
+        self._task = None
+        self._sending = False
+
+    # Record the full text so far and send it if the policy allows
+    def update(self, text: str):
+        self._text = text
+        # Without a stream id the channel supports neither streaming nor updates
+        if self._stream_id is None:
+            return
+        if (self._task is None or self._task.done()) and self._due():
+            self._task = asyncio.create_task(self._flush())
+
+    # Wait for the update in flight, drop pending ones and send the final message
+    async def finish(self, text: str):
+        if self._task is not None and not self._task.done():
+            if not self._sending:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.stream_sequence += 1
+        await self._send(text, self.stream_sequence, "message")
+
+    def _due(self):
+        elapsed = time.monotonic() - self._sent_at
+        new_chars = len(self._text) - self._sent_length
+        return new_chars > 0 and elapsed >= self._min_interval and (new_chars >= self._min_chars or elapsed >= self._max_interval)
+
+    async def _flush(self):
+        while True:
+            text = self._text
+            self._sent_length = len(text)
+            self._sent_at = time.monotonic()
+            self.stream_sequence += 1
+            self._sending = True
+            try:
+                await self._send(self._format(text) if self._format else text, self.stream_sequence, "typing")
+            except Exception as error:
+                print(f"\n [stream] interim update failed: {error}", file=sys.stderr)
+                return
+            finally:
+                self._sending = False
+            # Text that arrived while sending goes out once it is due, without waiting for the next update
+            delay = self._min_interval - (time.monotonic() - self._sent_at)
+            if len(self._text) == self._sent_length:
+                return
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not self._due():
+                return
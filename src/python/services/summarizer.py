@@ -0,0 +1,33 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from typing import Awaitable, Callable
+
+from data_models import ConversationTurn
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new turns into the existing summary. Keep facts, names, decisions and open "
+    "questions the assistant may need later. Answer with the summary only, in at most 200 words."
+)
+
+class Summarizer:
+
+    def __init__(
+            self,
+            create_completion: Callable[[list[dict]], Awaitable[str]]
+    ):
+        self._create_completion = create_completion
+
+    # Fold turns evicted from the history window into the conversation summary
+    async def summarize(
+            self,
+            summary: str,
+            turns: list[ConversationTurn]
+    ) -> str:
+        transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+        updated = await self._create_completion([
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"}
+        ])
+        return updated.strip() if updated else summary
@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import asyncio
+from collections import deque
+
+from openai import AsyncAzureOpenAI
+
+# Keeps a few pre-created assistant threads per worker so a new conversation
+# doesn't wait for threads.create. The pool is refilled in the background after
+# each acquire, and threads still unused at shutdown are deleted.
+class ThreadPool:
+
+    def __init__(
+            self,
+            aoai_client: AsyncAzureOpenAI,
+            size: int = 4,
+            retry_delay: float = 5
+    ):
+        self._threads_client = aoai_client.beta.threads
+        self._size = size
+        self._retry_delay = retry_delay
+        self._threads = deque()
+        self._refill_task = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+
+    # Start filling the pool, must be called on the running event loop
+    def start(self):
+        self._refill()
+
+    async def acquire(self) -> str:
+        if len(self._threads) > 0:
+            self.hits += 1
+            thread_id = self._threads.popleft()
+        else:
+            self.misses += 1
+            thread_id = (await self._threads_client.create()).id
+        self._refill()
+        return thread_id
+
+    def stats(self):
+        acquired = self.hits + self.misses
+        return {
+            "pooled": len(self._threads),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / acquired if acquired else 0.0,
+        }
+
+    async def close(self):
+        self._closed = True
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+        threads = list(self._threads)
+        self._threads.clear()
+        results = await asyncio.gather(
+            *[self._threads_client.delete(thread_id) for thread_id in threads],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"\n [thread pool] failed to delete thread: {result}", file=sys.stderr)
+
+    def _refill(self):
+        if self._closed or self._size <= 0:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        while len(self._threads) < self._size:
+            try:
+                thread = await self._threads_client.create()
+            except Exception as error:
+                # Back off when the service is unavailable, acquire still creates threads directly
+                print(f"\n [thread pool] failed to create thread: {error}", file=sys.stderr)
+                await asyncio.sleep(self._retry_delay)
+                continue
+            self._threads.append(thread.id)
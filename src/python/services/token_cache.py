@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import time
+from collections import OrderedDict
+
+import jwt
+
+# Caches the claims of validated SSO tokens per user and channel so turns don't
+# call the token service while the token is still valid. An entry expires
+# refresh_margin seconds before the token's exp claim, and never lives longer
+# than max_ttl seconds so revoked tokens are eventually noticed. Entries also
+# record the user's session version and only match the same version, so a
+# logout that bumps it in shared state invalidates the entry on every worker.
+class TokenCache:
+
+    def __init__(
+            self,
+            refresh_margin: float = 300,
+            max_ttl: float = 3600,
+            max_entries: int = 10000
+    ):
+        self._entries = OrderedDict()
+        self._refresh_margin = refresh_margin
+        self._max_ttl = max_ttl
+        self._max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str, channel_id: str, session: int = 0) -> dict:
+        key = (user_id, channel_id)
+        entry = self._entries.get(key)
+        if entry is None or time.time() >= entry[0] or entry[2] != session:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    # Decodes the token and caches its claims. Raises if the token can't be decoded.
+    def set(self, user_id: str, channel_id: str, token: str, session: int = 0) -> dict:
+        claims = jwt.decode(token, options={"verify_signature": False})
+        now = time.time()
+        expires_at = now + self._max_ttl
+        if claims.get("exp") is not None:
+            expires_at = min(expires_at, float(claims["exp"]) - self._refresh_margin)
+        if expires_at > now:
+            self._entries[(user_id, channel_id)] = (expires_at, claims, session)
+            self._entries.move_to_end((user_id, channel_id))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def invalidate(self, user_id: str, channel_id: str):
+        self._entries.pop((user_id, channel_id), None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,88 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import time
+import asyncio
+import traceback
+from typing import Awaitable, Callable
+
+class TurnQueue:
+
+    def __init__(
+            self,
+            process: Callable[..., Awaitable],
+            max_size: int = 1000,
+            workers: int = 32
+    ):
+        self._process = process
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._max_size = max_size
+        self._worker_count = workers
+        self._workers = []
+        self._stopping = False
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._total_wait = 0.0
+        self.max_wait = 0.0
+
+    # Worker tasks must be created on the running event loop
+    def start(self):
+        for _ in range(self._worker_count):
+            self._workers.append(asyncio.create_task(self._work()))
+
+    # Stops accepting turns and gives the accepted ones up to grace seconds to
+    # finish, since their senders already got a 202, before cancelling the rest
+    async def stop(self, grace: float = 25):
+        self._stopping = True
+        if len(self._workers) > 0:
+            try:
+                await asyncio.wait_for(self._queue.join(), grace)
+            except asyncio.TimeoutError:
+                print(f"\n [turn_queue] shutdown grace expired, cancelling running turns and dropping {self._queue.qsize()} queued ones", file=sys.stderr)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    # Returns False when the queue is full, so the caller can shed the request
+    def try_enqueue(self, *args) -> bool:
+        if self._stopping:
+            self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), args))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    def stats(self):
+        return {
+            "depth": self._queue.qsize(),
+            "max_size": self._max_size,
+            "workers": self._worker_count,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "average_wait_seconds": self._total_wait / self.processed if self.processed else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
+
+    async def _work(self):
+        while True:
+            enqueued_at, args = await self._queue.get()
+            wait = time.monotonic() - enqueued_at
+            try:
+                await self._process(*args)
+            except Exception:
+                self.failed += 1
+                print("\n [turn_queue] turn processing failed", file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+            # Turns cancelled at shutdown skip this and are not counted
+            self.processed += 1
+            self._total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
@@ -0,0 +1,112 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import copy
+import time
+import pickle
+from collections import OrderedDict
+from typing import Dict, List
+
+from botbuilder.core import Storage
+
+
+class StoredItem:
+    __slots__ = ("data", "e_tag", "last_access")
+
+    def __init__(self, data: bytes, e_tag: str, last_access: float):
+        self.data = data
+        self.e_tag = e_tag
+        self.last_access = last_access
+
+
+# In-process storage bounded by entry count and size. Items are kept pickled,
+# ordered by last access, and evicted least recently used first or once they
+# have been idle for longer than the TTL. ETags behave like MemoryStorage.
+class BoundedMemoryStorage(Storage):
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 86400):
+        self._items = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._bytes = 0
+        self._e_tag = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+    async def read(self, keys: List[str]) -> Dict[str, object]:
+        now = time.monotonic()
+        self._expire(now)
+        data = {}
+        for key in keys:
+            item = self._items.get(key)
+            if item is None:
+                continue
+            item.last_access = now
+            self._items.move_to_end(key)
+            data[key] = pickle.loads(item.data)
+        return data
+
+    async def write(self, changes: Dict[str, object]):
+        now = time.monotonic()
+        self._expire(now)
+        for key, change in changes.items():
+            old_item = self._items.get(key)
+            new_e_tag = change.get("e_tag") if isinstance(change, dict) else getattr(change, "e_tag", None)
+            if new_e_tag == "":
+                raise Exception("bounded_memory_storage.write(): etag missing")
+            if (
+                old_item is not None
+                and new_e_tag is not None
+                and new_e_tag != "*"
+                and new_e_tag != old_item.e_tag
+            ):
+                raise KeyError(
+                    f"Etag conflict.\nOriginal: {new_e_tag}\r\nCurrent: {old_item.e_tag}"
+                )
+
+            # Stamp the stored snapshot, leaving the caller's object untouched
+            e_tag = str(self._e_tag)
+            self._e_tag += 1
+            if isinstance(change, dict):
+                change = {**change, "e_tag": e_tag}
+            elif hasattr(change, "e_tag"):
+                change = copy.copy(change)
+                change.e_tag = e_tag
+            self._remove(key)
+            item = StoredItem(pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL), e_tag, now)
+            self._items[key] = item
+            self._bytes += len(item.data)
+        self._evict()
+
+    async def delete(self, keys: List[str]):
+        for key in keys:
+            self._remove(key)
+
+    def stats(self):
+        return {
+            "entries": len(self._items),
+            "bytes": self._bytes,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+        }
+
+    def _remove(self, key: str):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item.data)
+
+    def _expire(self, now: float):
+        # The least recently used item is first, so stop at the first fresh one
+        while self._items:
+            key, item = next(iter(self._items.items()))
+            if now - item.last_access <= self._ttl_seconds:
+                break
+            self._remove(key)
+            self.evicted_ttl += 1
+
+    def _evict(self):
+        # Always keep the most recent item, even if it alone exceeds the byte limit
+        while len(self._items) > 1 and (len(self._items) > self._max_entries or self._bytes > self._max_bytes):
+            self._remove(next(iter(self._items)))
+            self.evicted_lru += 1
@@ -0,0 +1,148 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import copy
+import pickle
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from botbuilder.core import Storage
+
+
+# File-backed storage shared by every worker process on a node. SQLite runs in
+# WAL mode so readers in one process don't block writers in another. All
+# database access happens on a single background thread, and writes issued
+# within batch_interval seconds are committed together in one transaction.
+class SqliteStorage(Storage):
+
+    def __init__(self, path: str, batch_interval: float = 0.005, busy_timeout: float = 5.0):
+        self._path = path
+        self._batch_interval = batch_interval
+        self._busy_timeout = busy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._connection = None
+        self._pending = []
+        self._flush_task = None
+
+    async def read(self, keys: List[str]) -> Dict[str, object]:
+        if not keys:
+            return {}
+        rows = await self._run(self._read_rows, keys)
+        data = {}
+        for key, blob, e_tag in rows:
+            data[key] = self._with_e_tag(pickle.loads(blob), str(e_tag))
+        return data
+
+    async def write(self, changes: Dict[str, object]):
+        if not changes:
+            return
+        # Snapshot now, since callers keep mutating their state objects
+        items = []
+        for key, change in changes.items():
+            e_tag = change.get("e_tag") if isinstance(change, dict) else getattr(change, "e_tag", None)
+            if e_tag == "":
+                raise Exception("sqlite_storage.write(): etag missing")
+            items.append((key, pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL), e_tag))
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((items, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+
+    async def delete(self, keys: List[str]):
+        if keys:
+            await self._run(self._delete_rows, keys)
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    async def _flush(self):
+        await asyncio.sleep(self._batch_interval)
+        batch, self._pending = self._pending, []
+        self._flush_task = None
+        try:
+            errors = await self._run(self._write_batch, [items for items, _ in batch])
+        except Exception as error:
+            errors = [error] * len(batch)
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _with_e_tag(item: object, e_tag: str):
+        if isinstance(item, dict):
+            item["e_tag"] = e_tag
+        elif hasattr(item, "e_tag"):
+            item = copy.copy(item)
+            item.e_tag = e_tag
+        return item
+
+    # The methods below run on the storage thread
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, timeout=self._busy_timeout, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, data BLOB NOT NULL, e_tag INTEGER NOT NULL)"
+            )
+        return self._connection
+
+    def _read_rows(self, keys: List[str]):
+        connection = self._connect()
+        placeholders = ",".join("?" * len(keys))
+        return connection.execute(f"SELECT key, data, e_tag FROM state WHERE key IN ({placeholders})", keys).fetchall()
+
+    def _delete_rows(self, keys: List[str]):
+        connection = self._connect()
+        connection.executemany("DELETE FROM state WHERE key = ?", [(key,) for key in keys])
+
+    def _write_batch(self, batch: list):
+        # Each write call gets its own savepoint, so an ETag conflict only fails
+        # that call while the rest of the batch commits
+        connection = self._connect()
+        errors = []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for items in batch:
+                connection.execute("SAVEPOINT write_call")
+                try:
+                    for key, blob, e_tag in items:
+                        row = connection.execute("SELECT e_tag FROM state WHERE key = ?", (key,)).fetchone()
+                        if row is not None and e_tag is not None and e_tag != "*" and e_tag != str(row[0]):
+                            raise KeyError(f"Etag conflict.\nOriginal: {e_tag}\r\nCurrent: {row[0]}")
+                        connection.execute(
+                            "INSERT INTO state (key, data, e_tag) VALUES (?, ?, 1) "
+                            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, e_tag = state.e_tag + 1",
+                            (key, blob)
+                        )
+                    connection.execute("RELEASE write_call")
+                    errors.append(None)
+                except Exception as error:
+                    connection.execute("ROLLBACK TO write_call")
+                    connection.execute("RELEASE write_call")
+                    errors.append(error)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return errors
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import sys
+import unittest
+from collections import Counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.load_balancing_transport import Backend, LoadBalancingTransport
+
+URL = "https://primary.openai.azure.com/openai/deployments/gpt/chat/completions?api-version=v"
+
+# Answers per backend host and records which hosts were called
+class FakeBackends:
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+        self.calls = Counter()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls[request.url.host] += 1
+        return self.handlers[request.url.host](request)
+
+def ok(request):
+    return httpx.Response(200, json={"choices": []})
+
+def not_found(request):
+    return httpx.Response(404, json={"error": {"code": "DeploymentNotFound"}})
+
+class LoadBalancingTransportTest(unittest.IsolatedAsyncioTestCase):
+
+    def client(self, backends: FakeBackends, hosts: list[str], **options):
+        transport = LoadBalancingTransport(
+            [Backend(f"https://{host}", "gpt") for host in hosts],
+            transport=httpx.MockTransport(backends),
+            **options
+        )
+        return httpx.AsyncClient(transport=transport), transport
+
+    async def test_misconfigured_backend_is_taken_out_of_rotation(self):
+        backends = FakeBackends({"good": ok, "bad": not_found})
+        client, transport = self.client(backends, ["bad", "good"])
+        async with client:
+            for _ in range(10):
+                response = await client.post(URL, json={})
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(backends.calls["bad"], 1)
+        self.assertEqual(backends.calls["good"], 10)
+        self.assertTrue(transport.stats()[0]["unhealthy"])
+        self.assertFalse(transport.stats()[0]["available"])
+
+    async def test_misconfigured_backends_answer_when_nothing_else_is_left(self):
+        backends = FakeBackends({"bad": not_found})
+        client, _ = self.client(backends, ["bad"])
+        async with client:
+            for _ in range(3):
+                response = await client.post(URL, json={})
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(backends.calls["bad"], 3)
+
+    async def test_backends_without_quota_headers_share_the_load(self):
+        def limited(request):
+            return httpx.Response(200, headers={
+                "x-ratelimit-remaining-requests": "100",
+                "x-ratelimit-remaining-tokens": "100000",
+            }, json={"choices": []})
+
+        backends = FakeBackends({"a": ok, "b": limited, "c": ok})
+        client, _ = self.client(backends, ["a", "b", "c"])
+        async with client:
+            for _ in range(30):
+                await client.post(URL, json={})
+        self.assertEqual(backends.calls, Counter({"a": 10, "b": 10, "c": 10}))
+
+    async def test_backends_are_probed_before_ranking_by_quota(self):
+        def limited(remaining):
+            return lambda request: httpx.Response(200, headers={
+                "x-ratelimit-remaining-tokens": str(remaining),
+            }, json={"choices": []})
+
+        backends = FakeBackends({"a": limited(1000), "b": limited(5000)})
+        client, _ = self.client(backends, ["a", "b"])
+        async with client:
+            for _ in range(5):
+                await client.post(URL, json={})
+        self.assertEqual(backends.calls, Counter({"a": 1, "b": 4}))
+
+    async def test_throttled_backend_is_retried_elsewhere(self):
+        def throttled(request):
+            return httpx.Response(429, headers={"retry-after": "30"}, json={})
+
+        backends = FakeBackends({"a": throttled, "b": ok})
+        client, _ = self.client(backends, ["a", "b"])
+        async with client:
+            for _ in range(4):
+                response = await client.post(URL, json={})
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(backends.calls, Counter({"a": 1, "b": 4}))
+
+    async def test_other_deployments_stay_on_the_primary_endpoint(self):
+        backends = FakeBackends({"primary.openai.azure.com": ok})
+        client, _ = self.client(backends, ["a", "b"])
+        async with client:
+            response = await client.post(URL.replace("/gpt/", "/embeddings/"), json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(backends.calls, Counter({"primary.openai.azure.com": 1}))
+
+if __name__ == "__main__":
+    unittest.main()
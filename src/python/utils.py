@@ -1,4 +1,6 @@
 import re
+import asyncio
+from contextlib import asynccontextmanager
 from botbuilder.core import CardFactory
 from botbuilder.schema import Activity, ActivityTypes
 
@@ -12,6 +14,10 @@ def get_super(x):
 def replace_citations(x): 
     return re.sub(r"\[doc(\d+)\]", lambda match: f"{get_super(match.group(1))}", str(x))
 
+def replace_citations_streaming(x):
+    # Hold back a trailing "[docN" marker that may be completed by the next chunk
+    return replace_citations(re.sub(r"\[(d(o(c\d*)?)?)?$", "", str(x)))
+
 def get_citations_card(citations):
     return  Activity(
                 text="Citations",
@@ -105,4 +111,20 @@ def get_citations_card(citations):
         "version": "1.3",
         "fallbackText": "This card requires Adaptive Cards v1.2 support to be rendered properly."
     })])
-    
\ No newline at end of file
+
+# Async locks by key, dropped once no turn holds or waits for them
+class KeyedLock:
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]